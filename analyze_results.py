@@ -1,161 +1,329 @@
 #!/usr/bin/env python3
 
-import math
 import multiprocessing
 import json
+from array import array
+from collections import namedtuple
+from functools import partial
 
-from bootstrap import get_mobility_session
+import numpy as np
 
+from bootstrap import get_mobility_session, load_config
+
+import delivery_store
 import model
 
 
-def stats_heard(heard_deliveries):
+DeliveryColumns = namedtuple('DeliveryColumns', ['sender', 'broadcast', 'time', 'heard', 'decrypted'])
+
+
+def stream_delivery_rows(session, experiment_id, batch_size=10000):
+    """Yields the sender, broadcast id, broadcast time, recipient and decrypted flag of every delivery of an experiment
+    in delivery order, fetching batch_size rows at a time (through a server-side cursor on postgres) instead of
+    loading them all."""
+    return session.query(model.Broadcast.sender_id, model.Delivery.broadcast_id, model.Broadcast.time,
+                         model.Delivery.recipient_id, model.Delivery.decrypted). \
+        join(model.Broadcast, model.Delivery.broadcast_id == model.Broadcast.id). \
+        filter(model.Delivery.experiment_id == experiment_id). \
+        order_by(model.Delivery.id).yield_per(batch_size)
+
+
+def fetch_delivery_columns(session, experiment_id):
+    """Returns the sender, broadcast id and broadcast time of every delivery of an experiment, together with masks
+    of the deliveries that were heard and decrypted, as arrays in delivery order."""
+    sender, broadcast, time = array('q'), array('q'), array('q')
+    heard, decrypted = bytearray(), bytearray()
+    for row in stream_delivery_rows(session, experiment_id):
+        sender.append(row[0])
+        broadcast.append(row[1])
+        time.append(row[2])
+        heard.append(row[3] is not None)
+        decrypted.append(bool(row[4]))
+    return DeliveryColumns(
+        sender=np.frombuffer(sender, dtype=np.int64),
+        broadcast=np.frombuffer(broadcast, dtype=np.int64),
+        time=np.frombuffer(time, dtype=np.int64),
+        heard=np.frombuffer(heard, dtype=bool),
+        decrypted=np.frombuffer(decrypted, dtype=bool)
+    )
+
+
+def read_delivery_columns(directory, experiment_id):
+    """Returns the parameters and the delivery columns of an experiment from the columnar delivery store."""
+    params, deliveries = delivery_store.open_deliveries(directory, experiment_id)
+    broadcasts = delivery_store.open_broadcasts(directory, params["broadcast_frequency"])
+    position = np.searchsorted(broadcasts["id"], deliveries["broadcast_id"])
+    found = position < len(broadcasts["id"])
+    found[found] = broadcasts["id"][position[found]] == deliveries["broadcast_id"][found]
+    if not found.all():
+        raise ValueError("deliveries of experiment {} refer to broadcasts that are not stored for frequency {}, "
+                         "e.g. {}; the broadcasts were generated again after the experiment was run".format(
+                             experiment_id, params["broadcast_frequency"],
+                             int(deliveries["broadcast_id"][np.argmin(found)])))
+    return params, DeliveryColumns(
+        sender=broadcasts["sender_id"][position].astype(np.int64),
+        broadcast=deliveries["broadcast_id"].astype(np.int64),
+        time=broadcasts["time"][position].astype(np.int64),
+        heard=deliveries["recipient_id"] != delivery_store.NO_RECIPIENT,
+        decrypted=np.array(deliveries["decrypted"], dtype=bool)
+    )
+
+
+def _first_occurrences(values):
+    """Returns the indices of the first occurrence of every distinct value, in increasing order."""
+    _, first = np.unique(values, return_index=True)
+    first.sort()
+    return first
+
+
+def _count_by_sender(senders):
+    """Returns the distinct senders in order of first appearance and the number of times each appears."""
+    distinct, first, counts = np.unique(senders, return_index=True, return_counts=True)
+    order = np.argsort(first)
+    return distinct[order], counts[order]
+
+
+def _distinct_broadcasts(columns, mask):
+    """Returns the senders and times of the distinct broadcasts among the deliveries selected by mask, in order of
+    first delivery."""
+    broadcasts = columns.broadcast[mask]
+    first = _first_occurrences(broadcasts)
+    return broadcasts[first], columns.sender[mask][first], columns.time[mask][first]
+
+
+def stats_heard(columns):
     """Returns a list with the number of broadcasts sent by each node which were heard by at least one recipient."""
-    result = dict()
-    for delivery in heard_deliveries:
-        broadcast = delivery.broadcast
-        sender = broadcast.sender_id
-        result.setdefault(sender, set())
-        result[sender].add(broadcast.id)
-    return [len(r) for r in result.values()]
+    _, senders, _ = _distinct_broadcasts(columns, columns.heard)
+    return _count_by_sender(senders)[1].tolist()
 
 
-def stats_heard_with_repetition(heard_deliveries):
+def stats_heard_with_repetition(columns):
     """Returns a list with the number of deliveries of broadcasts sent by each node."""
-    result = dict()
-    for delivery in heard_deliveries:
-        broadcast = delivery.broadcast
-        sender = broadcast.sender_id
-        result.setdefault(sender, 0)
-        result[sender] += 1
-    return list(result.values())
+    return _count_by_sender(columns.sender[columns.heard])[1].tolist()
 
 
-def stats_unheard(unheard_deliveries):
+def stats_unheard(columns):
     """Returns a list with the number of broadcasts sent by each node which were not heard by any recipient."""
-    result = dict()
-    for delivery in unheard_deliveries:
-        broadcast = delivery.broadcast
-        sender = broadcast.sender_id
-        result.setdefault(sender, 0)
-        result[sender] += 1
-    return list(result.values())
+    return _count_by_sender(columns.sender[~columns.heard])[1].tolist()
 
 
-def stats_decrypted(decrypted_deliveries):
+def stats_decrypted(columns):
     """Returns a list with the number of broadcasts sent by each node which were decrypted by at least one recipient."""
-    result = dict()
-    for delivery in decrypted_deliveries:
-        broadcast = delivery.broadcast
-        sender = broadcast.sender_id
-        result.setdefault(sender, set())
-        result[sender].add(broadcast.id)
-    return [len(r) for r in result.values()]
+    _, senders, _ = _distinct_broadcasts(columns, columns.decrypted)
+    return _count_by_sender(senders)[1].tolist()
 
 
-def stats_decrypted_with_repetition(decrypted_deliveries):
+def stats_decrypted_with_repetition(columns):
     """Returns a list with the number of deliveries of broadcasts sent by each node which were decrypted."""
-    result = dict()
-    for delivery in decrypted_deliveries:
-        broadcast = delivery.broadcast
-        sender = broadcast.sender_id
-        result.setdefault(sender, 0)
-        result[sender] += 1
-    return list(result.values())
+    return _count_by_sender(columns.sender[columns.decrypted])[1].tolist()
 
 
-def stats_undecrypted(decrypted_deliveries, undecrypted_deliveries):
+def stats_undecrypted(columns):
     """Returns a list with the number of broadcasts sent by each node which were heard but not decrypted by any
     recipient."""
-    result = dict()
-    for delivery in undecrypted_deliveries:
-        broadcast = delivery.broadcast
-        sender = broadcast.sender_id
-        result.setdefault(sender, set())
-        result[sender].add(broadcast.id)
-
-    for delivery in decrypted_deliveries:
-        broadcast = delivery.broadcast
-        sender = broadcast.sender_id
-        result.setdefault(sender, set())
-        if broadcast.id in result[sender]:
-            result[sender].remove(broadcast.id)
-    return [len(r) for r in result.values()]
-
-
-def stats_hourly_at_least_once_decrypted(decrypted_deliveries):
+    undecrypted_mask = columns.heard & ~columns.decrypted
+    undecrypted, undecrypted_senders, _ = _distinct_broadcasts(columns, undecrypted_mask)
+    decrypted, decrypted_senders, _ = _distinct_broadcasts(columns, columns.decrypted)
+    never_decrypted = ~np.isin(undecrypted, decrypted)
+    counts = dict.fromkeys(_count_by_sender(undecrypted_senders)[0].tolist(), 0)
+    for sender in _count_by_sender(decrypted_senders)[0].tolist():
+        counts.setdefault(sender, 0)
+    senders, sender_counts = _count_by_sender(undecrypted_senders[never_decrypted])
+    for sender, count in zip(senders.tolist(), sender_counts.tolist()):
+        counts[sender] = count
+    return list(counts.values())
+
+
+def hours_for(total_time):
+    """returns the number of hourly buckets covering a simulation of total_time seconds"""
+    return max(-(-int(total_time) // 3600), 1)
+
+
+def _hourly_by_sender(senders, times, hours=48):
+    """Returns a dictionary mapping each sender, in order of first appearance, to the number of entries per hour, in
+    at least the given number of hours."""
+    if len(times):
+        hours = max(hours, int(times.max()) // 3600 + 1)
+    distinct, first, inverse = np.unique(senders, return_index=True, return_inverse=True)
+    rank = np.empty(len(distinct), dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(len(distinct))
+    buckets = np.bincount(rank[inverse] * hours + times // 3600,  # convert to previous hour
+                          minlength=len(distinct) * hours).reshape(len(distinct), hours)
+    return {sender: buckets[i].tolist() for i, sender in enumerate(distinct[np.argsort(first)].tolist())}
+
+
+def stats_hourly_at_least_once_decrypted(columns, hours=48):
     """Returns a dictionary mapping a node to a list of the hourly count of frames sent by it that were decrypted
      at least once."""
-    result = dict()
-    for delivery in decrypted_deliveries:
-        broadcast = delivery.broadcast
-        sender = broadcast.sender_id
-        result.setdefault(sender, 48 * [set()])
-        t = math.floor(broadcast.time / 3600)  # convert to previous hour
-        result[sender][t].add(broadcast.id)
-    return {sender: len(result[sender]) for sender in result}
+    _, senders, times = _distinct_broadcasts(columns, columns.decrypted)
+    return _hourly_by_sender(senders, times, hours)
 
 
-def stats_hourly_total_decrypted(decrypted_deliveries):
+def stats_hourly_total_decrypted(columns, hours=48):
     """Returns a dictionary mapping a node to a list of the hourly count of frames received by it that were
     decrypted."""
-    result = dict()
-    for delivery in decrypted_deliveries:
-        broadcast = delivery.broadcast
-        sender = broadcast.sender_id
-        result.setdefault(sender, 48 * [0])
-        t = math.floor(broadcast.time / 3600)  # convert to previous hour
-        result[sender][t] += 1
-    return result
-
-
-def produce_results(experiment_id):
-    _session = get_mobility_session()
-    experiment = _session.query(model.Experiment).get(experiment_id)
+    return _hourly_by_sender(columns.sender[columns.decrypted], columns.time[columns.decrypted], hours)
+
+
+class StatisticsAccumulator(object):
+    """Computes the statistics of compute_statistics online, from deliveries fed one at a time, without keeping them.
+
+    Instead of sets of broadcast ids, one byte of flags per broadcast id records whether the broadcast has been heard,
+    decrypted and heard without being decrypted so far. The hourly counts cover at least hours hours, and more if
+    later deliveries are added."""
+
+    HEARD = 1
+    DECRYPTED = 2
+    UNDECRYPTED = 4
+
+    def __init__(self, hours=48):
+        self.hours = hours
+        self.flags = bytearray()
+        self.heard = dict()
+        self.heard_repeated = dict()
+        self.unheard = dict()
+        self.decrypted = dict()
+        self.decrypted_repeated = dict()
+        self.undecrypted = dict()
+        self.hourly_once = dict()
+        self.hourly_total = dict()
+
+    def add(self, sender, broadcast_id, time, heard, decrypted):
+        """counts one delivery of a broadcast by sender at time"""
+        if broadcast_id >= len(self.flags):
+            self.flags.extend(bytes(max(broadcast_id + 1 - len(self.flags), len(self.flags))))
+        flags = self.flags[broadcast_id]
+        if not heard:
+            self.unheard[sender] = self.unheard.get(sender, 0) + 1
+            return
+        self.heard_repeated[sender] = self.heard_repeated.get(sender, 0) + 1
+        if not flags & self.HEARD:
+            flags |= self.HEARD
+            self.heard[sender] = self.heard.get(sender, 0) + 1
+        if decrypted:
+            hour = time // 3600  # convert to previous hour
+            self.decrypted_repeated[sender] = self.decrypted_repeated.get(sender, 0) + 1
+            if hour >= self.hours:
+                self.hours = hour + 1
+            hourly_total = self.hourly_total.setdefault(sender, self.hours * [0])
+            if hour >= len(hourly_total):
+                hourly_total.extend((self.hours - len(hourly_total)) * [0])
+            hourly_total[hour] += 1
+            if not flags & self.DECRYPTED:
+                flags |= self.DECRYPTED
+                self.decrypted[sender] = self.decrypted.get(sender, 0) + 1
+                hourly_once = self.hourly_once.setdefault(sender, self.hours * [0])
+                if hour >= len(hourly_once):
+                    hourly_once.extend((self.hours - len(hourly_once)) * [0])
+                hourly_once[hour] += 1
+                if flags & self.UNDECRYPTED:
+                    self.undecrypted[sender] -= 1
+        elif not flags & self.UNDECRYPTED:
+            flags |= self.UNDECRYPTED
+            self.undecrypted[sender] = self.undecrypted.get(sender, 0) + (0 if flags & self.DECRYPTED else 1)
+        self.flags[broadcast_id] = flags
+
+    def statistics(self):
+        """returns the statistics of the deliveries added so far"""
+        undecrypted = dict(self.undecrypted)
+        for sender in self.decrypted:
+            undecrypted.setdefault(sender, 0)
+        return dict(
+            heard=list(self.heard.values()),
+            heard_repeated=list(self.heard_repeated.values()),
+            unheard=list(self.unheard.values()),
+            decrypted=list(self.decrypted.values()),
+            decrypted_repeated=list(self.decrypted_repeated.values()),
+            undecrypted=list(undecrypted.values()),
+            hourly_once={sender: buckets + (self.hours - len(buckets)) * [0]
+                         for sender, buckets in self.hourly_once.items()},
+            hourly_total={sender: buckets + (self.hours - len(buckets)) * [0]
+                          for sender, buckets in self.hourly_total.items()}
+        )
 
-    """returns a nested dict containing params and results for one specific experiment"""
-    print("{}: working on {}".format(experiment.id, experiment))
-    print("{}: gathering delivery information".format(experiment.id))
 
-    heard_deliveries = experiment.heard_deliveries
-    unheard_deliveries = experiment.unheard_deliveries
-    decrypted_deliveries = experiment.decrypted_deliveries
-    undecrypted_deliveries = experiment.undecrypted_deliveries
+def stream_statistics(session, experiment_id, hours=48):
+    """Computes the statistics of compute_statistics in a single pass over the deliveries of an experiment in the
+    database, without keeping them in memory."""
+    accumulator = StatisticsAccumulator(hours)
+    for sender, broadcast_id, time, recipient_id, decrypted in stream_delivery_rows(session, experiment_id):
+        accumulator.add(sender, broadcast_id, time, recipient_id is not None, bool(decrypted))
+    return accumulator.statistics()
 
-    print("{}: calculating stats".format(experiment.id))
 
-    out = dict(
+def results_dict(params, statistics):
+    """returns the nested dict written for an experiment"""
+    return dict(
         params=dict(
-            group_limit=experiment.group_limit,
-            group_size_limit=experiment.group_size_limit,
-            broadcast_frequency=experiment.broadcast_frequency
+            group_limit=params["group_limit"],
+            group_size_limit=params["group_size_limit"],
+            broadcast_frequency=params["broadcast_frequency"]
         ),
-        statistics=dict(
-            heard=stats_heard(heard_deliveries),
-            heard_repeated=stats_heard_with_repetition(heard_deliveries),
-            unheard=stats_unheard(unheard_deliveries),
-            decrypted=stats_decrypted(decrypted_deliveries),
-            decrypted_repeated=stats_decrypted_with_repetition(decrypted_deliveries),
-            undecrypted=stats_undecrypted(decrypted_deliveries, undecrypted_deliveries),
-            hourly_once=stats_hourly_at_least_once_decrypted(decrypted_deliveries),
-            hourly_total=stats_hourly_total_decrypted(decrypted_deliveries)
-        )
+        statistics=statistics
     )
 
-    print("{}: writing json", experiment.id)
 
-    with open('data/statistics_{}.json'.format(experiment.id), 'w') as f:
+def compute_statistics(params, columns, hours=48):
+    """returns a nested dict containing params and results for one specific experiment, with hourly counts over at
+    least the given number of hours"""
+    return results_dict(params, dict(
+        heard=stats_heard(columns),
+        heard_repeated=stats_heard_with_repetition(columns),
+        unheard=stats_unheard(columns),
+        decrypted=stats_decrypted(columns),
+        decrypted_repeated=stats_decrypted_with_repetition(columns),
+        undecrypted=stats_undecrypted(columns),
+        hourly_once=stats_hourly_at_least_once_decrypted(columns, hours),
+        hourly_total=stats_hourly_total_decrypted(columns, hours)
+    ))
+
+
+def write_results(experiment_id, out):
+    print("{}: writing json".format(experiment_id))
+
+    with open('data/statistics_{}.json'.format(experiment_id), 'w') as f:
         json.dump(out, f)
 
-    print("{}:finished".format(experiment.id))
+    print("{}:finished".format(experiment_id))
 
-    session.close()
 
+def produce_results(experiment_id, hours=48):
+    """writes a json file containing params and results for one specific experiment, streaming its deliveries from
+    the database so that memory use does not grow with the number of deliveries"""
+    _session = get_mobility_session()
+    experiment = _session.query(model.Experiment).get(experiment_id)
 
-if __name__ == '__main__':
-    session = get_mobility_session()
+    print("{}: working on {}".format(experiment.id, experiment))
+    print("{}: calculating stats from the streamed deliveries".format(experiment.id))
+
+    params = dict(group_limit=experiment.group_limit, group_size_limit=experiment.group_size_limit,
+                  broadcast_frequency=experiment.broadcast_frequency)
+    write_results(experiment.id, results_dict(params, stream_statistics(_session, experiment.id, hours)))
+
+    _session.close()
 
-    pool = multiprocessing.Pool()
 
-    results = pool.map(produce_results, session.query(model.Experiment.id).distinct())
+def produce_results_from_store(args):
+    """like produce_results, but reads the deliveries from the columnar delivery store instead of the database"""
+    directory, experiment_id, hours = args
+    print("{}: gathering delivery information".format(experiment_id))
+    params, columns = read_delivery_columns(directory, experiment_id)
+    print("{}: calculating stats".format(experiment_id))
+    write_results(experiment_id, compute_statistics(params, columns, hours))
 
+
+if __name__ == '__main__':
+    data_dict = load_config()
+
+    pool = multiprocessing.Pool()
+    # one hourly bucket per hour of the simulation:
+    hours = hours_for(data_dict["total_time"])
+
+    if data_dict.get("output", "database") == "columnar":
+        directory = data_dict.get("output_directory", "data/deliveries")
+        results = pool.map(produce_results_from_store,
+                           [(directory, experiment_id, hours)
+                            for experiment_id in delivery_store.stored_experiments(directory)])
+    else:
+        session = get_mobility_session()
+        results = pool.map(partial(produce_results, hours=hours), session.query(model.Experiment.id).distinct())
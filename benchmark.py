@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""Benchmarks every stage of the pipeline on a synthetic mobility trace.
+
+A linkdump file with the requested number of nodes, contact density and duration is generated, and the stages
+parse_mobility_data, load_cached_trace (reading the parsed trace back from its cache), create_group,
+generate_broadcasts, simulate and analyze are run against a SQLite database (a temporary file by default, the
+in-memory backend with --database memory, or any other database url). For every stage the wall time, peak resident
+memory and the number of events processed per second are written as JSON, e.g.
+
+    python3 benchmark.py --nodes 100 --duration 86400 --frequency 25 --json bench.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import analyze_results
+import bootstrap
+import initialize_data
+import mobility_cache
+import model
+import simulate
+
+
+def generate_linkdump(path, node_count, density, duration, contacts_per_pair=5, contact_length=300, seed=None):
+    """writes a synthetic mobility trace and returns the number of contacts in it
+
+    Each pair of nodes meets with probability density; a pair that meets has on average contacts_per_pair contacts,
+    starting at uniformly random times and lasting contact_length seconds on average."""
+    rng = random.Random(seed)
+    contact_count = 0
+    with open(path, 'w') as f:
+        for x in range(node_count):
+            for y in range(x + 1, node_count):
+                if rng.random() >= density:
+                    continue
+                intervals = []
+                for _ in range(max(1, int(rng.expovariate(1.0 / contacts_per_pair)))):
+                    start = rng.uniform(0, duration)
+                    end = min(start + 1 + rng.expovariate(1.0 / contact_length), duration)
+                    intervals.append("{:.1f}*{:.1f}".format(start, end))
+                f.write("{} {} {}\n".format(x, y, " ".join(intervals)))
+                contact_count += len(intervals)
+    return contact_count
+
+
+def _resident_memory():
+    """returns the resident set size of this process in bytes"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class PeakMemory(object):
+    """Samples the resident set size in a background thread and keeps its maximum.
+
+    Sampling keeps the overhead on the measured code negligible, unlike tracing every allocation. Where /proc is not
+    available, the peak of the whole process so far is reported instead."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, _resident_memory())
+            if self._stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        if os.path.exists("/proc/self/statm"):
+            self.start = _resident_memory()
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread.is_alive():
+            self._stop.set()
+            self._thread.join()
+        else:
+            import resource
+            self.start = 0
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(stage, function, results):
+    """runs function, which returns the number of events it processed, and appends its measurements to results"""
+    with PeakMemory() as memory:
+        start_time = time.perf_counter()
+        events = function()
+        wall_time = time.perf_counter() - start_time
+    results.append(dict(stage=stage, wall_time=wall_time, peak_memory=memory.peak,
+                        memory_increase=memory.peak - memory.start, events=events,
+                        events_per_second=events / wall_time if wall_time > 0 else None))
+    print("{}: {:.3f}s, {:.1f} MiB peak, {} events ({:.0f}/s)".format(stage, wall_time, memory.peak / 2 ** 20, events,
+                                                                      events / max(wall_time, 1e-9)),
+          file=sys.stderr)
+
+
+def run_benchmark(args, directory):
+    trace = os.path.join(directory, "synthetic.linkdump")
+    contact_count = generate_linkdump(trace, args.nodes, args.density, args.duration, args.contacts_per_pair,
+                                      args.contact_length, args.seed)
+    database = args.database or "sqlite:///{}".format(os.path.join(directory, "benchmark.db"))
+    bootstrap.create_schema(bootstrap.get_engine(database))
+    session = bootstrap.get_mobility_session(database=database)
+    random.seed(args.seed)
+    results = []
+    graph = dict()
+    experiment = model.Experiment(group_limit=args.group_limit, group_size_limit=args.group_size_limit,
+                                  broadcast_frequency=args.frequency, completed=False)
+
+    def parse():
+        graph["contacts"] = initialize_data.parse_mobility_data(session, trace,
+                                                                cache_directory=os.path.join(directory, "cache"))
+        return contact_count
+
+    def reload():
+        return len(mobility_cache.load_mobility_trace(trace, os.path.join(directory, "cache")).time_start)
+
+    def groups():
+        initialize_data.create_group(session, graph["contacts"].copy(), args.group_limit, args.group_size_limit)
+        return session.query(model.Group).count()
+
+    def broadcasts():
+        initialize_data.generate_broadcasts(session, args.frequency, args.duration, args.seed)
+        return session.query(model.Broadcast).count()
+
+    def simulation():
+        session.add(experiment)
+        session.commit()
+        options = simulate.RunOptions(output=args.output, output_directory=os.path.join(directory, "deliveries"),
+                                      seed=args.seed)
+        simulate.run_experiment(session, experiment.id, args.duration, options)
+        return session.query(model.Broadcast).count()
+
+    def analysis():
+        if args.output == 'columnar':
+            params, columns = analyze_results.read_delivery_columns(os.path.join(directory, "deliveries"),
+                                                                    experiment.id)
+        else:
+            params = dict(group_limit=experiment.group_limit, group_size_limit=experiment.group_size_limit,
+                          broadcast_frequency=experiment.broadcast_frequency)
+            columns = analyze_results.fetch_delivery_columns(session, experiment.id)
+        analyze_results.compute_statistics(params, columns, analyze_results.hours_for(args.duration))
+        return len(columns.sender)
+
+    measure("parse_mobility_data", parse, results)
+    measure("load_cached_trace", reload, results)
+    measure("create_group", groups, results)
+    measure("generate_broadcasts", broadcasts, results)
+    measure("simulate", simulation, results)
+    measure("analyze", analysis, results)
+    session.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the simulation pipeline on a synthetic mobility trace.")
+    parser.add_argument("--nodes", type=int, default=50, help="number of nodes in the trace")
+    parser.add_argument("--density", type=float, default=0.2, help="probability that two nodes ever meet")
+    parser.add_argument("--contacts-per-pair", type=float, default=5, help="mean number of contacts of a pair")
+    parser.add_argument("--contact-length", type=float, default=300, help="mean length of a contact in seconds")
+    parser.add_argument("--duration", type=int, default=86400, help="length of the trace and simulation in seconds")
+    parser.add_argument("--frequency", type=int, default=25, help="broadcast frequency in seconds")
+    parser.add_argument("--group-limit", type=int, default=3)
+    parser.add_argument("--group-size-limit", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", choices=["database", "columnar"], default="database",
+                        help="where the simulation stores its deliveries")
+    parser.add_argument("--database", help="database url, or 'memory' for an in-memory database; defaults to a "
+                                           "temporary SQLite file")
+    parser.add_argument("--json", dest="json_file", help="write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="f2fdtnsim-benchmark-")
+    try:
+        results = dict(params=vars(args), stages=run_benchmark(args, directory))
+    finally:
+        shutil.rmtree(directory)
+
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
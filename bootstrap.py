@@ -1,11 +1,96 @@
+import io
+import os
+
 import model
+import yaml
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+DEFAULT_DATABASE = 'postgresql://ana@/mobility'
+MEMORY_DATABASE = 'memory'
+
+_engines = dict()
+
+
+def load_config(path="config.yaml"):
+    """returns the parameters in config.yaml"""
+    with open(path, "r") as config_file:
+        return yaml.safe_load(config_file)
+
+
+def is_memory_database(database):
+    """tells whether database is the in-memory backend, whose data only lives as long as the current process"""
+    return database in (MEMORY_DATABASE, 'sqlite://', 'sqlite:///:memory:')
+
+
+def _enable_wal(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def create_storage_engine(database, echo=False, pool_size=5):
+    """returns an engine for a database url
+
+    - 'memory' is an in-memory SQLite database shared by all sessions of the process
+    - sqlite:///<file> is a file-backed SQLite database in WAL mode, so that readers do not block the writer
+    - any other url (e.g. postgresql://ana@/mobility) gets a pool of pool_size connections"""
+    if is_memory_database(database):
+        return create_engine('sqlite://', echo=echo, poolclass=StaticPool,
+                                   connect_args={'check_same_thread': False})
+    if make_url(database).get_backend_name() == 'sqlite':
+        engine = create_engine(database, echo=echo, connect_args={'timeout': 60})
+        event.listen(engine, "connect", _enable_wal)
+        return engine
+    return create_engine(database, echo=echo, pool_size=pool_size, max_overflow=pool_size, pool_pre_ping=True)
+
+
+def get_engine(database=None, echo=False):
+    """returns the engine of the configured database, creating it once per process
+
+    The database url and pool size are read from config.yaml unless database is given."""
+    config = None
+    if database is None:
+        config = load_config()
+        database = config.get("database", DEFAULT_DATABASE)
+    # engines must not be shared with forked processes:
+    key = (database, echo, os.getpid())
+    if key not in _engines:
+        if config is None and os.path.exists("config.yaml"):
+            config = load_config()
+        pool_size = (config or dict()).get("pool_size", 5)
+        _engines[key] = create_storage_engine(database, echo, pool_size)
+    return _engines[key]
+
+
+def insert_rows(session, table, columns, rows):
+    """inserts rows (tuples of values for columns) into table, using COPY when the database is postgres"""
+    if not rows:
+        return
+    if session.bind.dialect.name == 'postgresql':
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write("\t".join("\\N" if value is None else str(value) for value in row))
+            buffer.write("\n")
+        buffer.seek(0)
+        cursor = session.connection().connection.cursor()
+        cursor.copy_expert('COPY "{}" ({}) FROM STDIN'.format(table.name, ", ".join(columns)), buffer)
+    else:
+        session.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+
+
+def create_schema(engine):
+    """creates the tables of the data model that do not exist yet"""
+    model.Base.metadata.create_all(engine)
 
 
-def get_mobility_session(echo=False, autocommit=False):
+def get_mobility_session(echo=False, autocommit=False, database=None):
     """returns a session to the database"""
 
-    engine = model.create_engine('postgresql://ana@/mobility', echo=echo).execution_options(autocommit=autocommit)
+    engine = get_engine(database, echo).execution_options(autocommit=autocommit)
     model.Base.metadata.bind = engine
     DBSession = sessionmaker(bind=engine)
-    return DBSession()
\ No newline at end of file
+    return DBSession()
@@ -0,0 +1,230 @@
+"""Precomputed timeline of the contacts, for sweeping through time.
+
+The contacts are turned into a sorted sequence of events: a contact (node_1, node_2, b, e) comes up at time b and goes
+down at time e. Every slice_length seconds the adjacency at the start of the slice is stored as a snapshot in CSR form:
+row n of the snapshot of slice k lists one entry per contact of node n active at time k * slice_length. A consumer
+moving forward in time keeps the current adjacency and only applies the events in between, and can jump to the
+snapshot of any slice instead of replaying the events before it.
+
+A timeline is stored in one directory as .npy arrays, which are opened memory-mapped:
+
+- time (int64), node_1, node_2 (int32) and up (bool): the events, ordered by time, with down events before up events
+  of the same time
+- event_offsets (int64, one per slice): the number of events applied at the start of every slice
+- indptr (int64, slices x nodes + 1) and indices (int32): the snapshots; the row of node n in slice k is
+  indices[indptr[k, n]:indptr[k, n + 1]]
+
+As in contacts.py, a contact is active at time t if b < t < e: at time t, all events before t and the down events at t
+have been applied.
+
+recipients() looks up the neighbours of many nodes at once in the adjacency as a scipy.sparse matrix, whose entry
+(n, m) is the number of contacts between n and m that are active. It is rebuilt from the snapshot at the start of
+every slice and the events since are added to it as a sparse matrix of +1 and -1 entries.
+"""
+import json
+import os
+
+import numpy as np
+from scipy import sparse
+
+from model import Contact
+
+EVENT_COLUMNS = ('time', 'node_1', 'node_2', 'up')
+SNAPSHOT_COLUMNS = ('event_offsets', 'indptr', 'indices')
+
+
+def _save_column(path, name, values):
+    filename = os.path.join(path, name + ".npy")
+    temporary = "{}.{}.tmp".format(filename, os.getpid())
+    with open(temporary, 'wb') as f:
+        np.save(f, values)
+    os.replace(temporary, filename)
+
+
+class ContactTimeline(object):
+    """Contact events and per-slice adjacency snapshots, with the adjacency at the time of the last query."""
+
+    def __init__(self, columns, slice_length):
+        self.columns = columns
+        self.slice_length = slice_length
+        self.node_count = columns['indptr'].shape[1] - 1
+        self._load_snapshot(0)
+        self._matrix = None
+        self._matrix_time = None
+        self._matrix_position = None
+
+    @classmethod
+    def build(cls, node_1, node_2, time_start, time_end, slice_length=3600):
+        """computes the timeline of contacts given as arrays of their nodes, start and end times"""
+        node_1, node_2 = np.asarray(node_1, dtype=np.int32), np.asarray(node_2, dtype=np.int32)
+        time_start, time_end = np.asarray(time_start, dtype=np.int64), np.asarray(time_end, dtype=np.int64)
+        # contacts that end when they start are never active:
+        keep = time_start < time_end
+        node_1, node_2, time_start, time_end = node_1[keep], node_2[keep], time_start[keep], time_end[keep]
+        columns = dict()
+
+        time = np.concatenate([time_end, time_start])
+        up = np.repeat([False, True], len(time_start))
+        order = np.lexsort((up, time))
+        columns['time'] = time[order]
+        columns['node_1'] = np.tile(node_1, 2)[order]
+        columns['node_2'] = np.tile(node_2, 2)[order]
+        columns['up'] = up[order]
+
+        node_count = int(max(node_1.max(initial=0), node_2.max(initial=0))) + 1
+        slice_count = int(time_end.max(initial=0)) // slice_length + 1
+        slice_starts = np.arange(slice_count, dtype=np.int64) * slice_length
+        # the events applied at time s are those before s and the down events at s:
+        columns['event_offsets'] = np.searchsorted(columns['time'] * 2 + columns['up'], slice_starts * 2, 'right')
+
+        by_start = np.argsort(time_start, kind='stable')
+        starts = time_start[by_start]
+        max_length = int((time_end - time_start).max(initial=0))
+        indptr = np.empty((slice_count, node_count + 1), dtype=np.int64)
+        indices = []
+        offset = 0
+        for k, s in enumerate(slice_starts.tolist()):
+            # only contacts starting after s - max_length can still be active at s:
+            candidates = by_start[np.searchsorted(starts, s - max_length, 'right'):np.searchsorted(starts, s, 'left')]
+            active = candidates[time_end[candidates] > s]
+            rows = np.concatenate([node_1[active], node_2[active]])
+            peers = np.concatenate([node_2[active], node_1[active]])
+            order = np.lexsort((peers, rows))
+            indptr[k, 0] = offset
+            indptr[k, 1:] = offset + np.cumsum(np.bincount(rows, minlength=node_count))
+            indices.append(peers[order])
+            offset += len(rows)
+        columns['indptr'] = indptr
+        columns['indices'] = np.concatenate(indices).astype(np.int32)
+        return cls(columns, slice_length)
+
+    @classmethod
+    def from_session(cls, session, slice_length=3600):
+        """builds the timeline of the contact table"""
+        rows = session.query(Contact.node_1, Contact.node_2, Contact.time_start, Contact.time_end).all()
+        if not rows:
+            return cls.build([], [], [], [], slice_length)
+        return cls.build(*zip(*rows), slice_length=slice_length)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in EVENT_COLUMNS + SNAPSHOT_COLUMNS:
+            _save_column(directory, name, self.columns[name])
+        # the parameter file marks the timeline as complete, so it is written last:
+        with open(os.path.join(directory, "timeline.json"), 'w') as f:
+            json.dump(dict(slice_length=self.slice_length, node_count=self.node_count,
+                           slice_count=len(self.columns['event_offsets']), event_count=len(self.columns['time'])), f)
+
+    @classmethod
+    def open(cls, directory, mmap_mode='r'):
+        """opens a timeline stored with save()"""
+        with open(os.path.join(directory, "timeline.json")) as f:
+            params = json.load(f)
+        columns = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode=mmap_mode)
+                   for name in EVENT_COLUMNS + SNAPSHOT_COLUMNS}
+        return cls(columns, params["slice_length"])
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, "timeline.json"))
+
+    def slice(self, t):
+        """returns the index of the slice containing time t"""
+        return min(max(int(t // self.slice_length), 0), len(self.columns['event_offsets']) - 1)
+
+    def snapshot(self, k):
+        """returns the indptr and indices arrays of the adjacency at the start of slice k"""
+        indptr = self.columns['indptr'][k]
+        return indptr - indptr[0], self.columns['indices'][indptr[0]:indptr[-1]]
+
+    def _load_snapshot(self, k):
+        indptr, indices = self.snapshot(k)
+        indptr, indices = indptr.tolist(), indices.tolist()
+        self.adjacency = dict()
+        for node in np.flatnonzero(np.diff(indptr)).tolist():
+            peers = self.adjacency[node] = dict()
+            for peer in indices[indptr[node]:indptr[node + 1]]:
+                peers[peer] = peers.get(peer, 0) + 1
+        self.time = k * self.slice_length
+        self.position = int(self.columns['event_offsets'][k])
+
+    def _apply(self, node, peer, delta):
+        peers = self.adjacency.setdefault(node, dict())
+        count = peers.get(peer, 0) + delta
+        if count:
+            peers[peer] = count
+        else:
+            del peers[peer]
+
+    def _event_end(self, t):
+        """returns the number of events applied at time t"""
+        times, ups = self.columns['time'], self.columns['up']
+        end = int(np.searchsorted(times, t, 'left'))
+        while end < len(times) and times[end] == t and not ups[end]:
+            end += 1
+        return end
+
+    def advance(self, t):
+        """brings the current adjacency to time t, starting over from a snapshot when going back in time or when that
+        is cheaper than applying the events in between"""
+        columns = self.columns
+        k = self.slice(t)
+        if t < self.time or columns['event_offsets'][k] - self.position > columns['indptr'][k, -1] - \
+                columns['indptr'][k, 0]:
+            self._load_snapshot(k)
+        end = self._event_end(t)
+        if end > self.position:
+            for node_1, node_2, up in zip(columns['node_1'][self.position:end].tolist(),
+                                          columns['node_2'][self.position:end].tolist(),
+                                          columns['up'][self.position:end].tolist()):
+                delta = 1 if up else -1
+                self._apply(node_1, node_2, delta)
+                self._apply(node_2, node_1, delta)
+            self.position = end
+        self.time = t
+
+    def neighbours(self, node, t):
+        """returns the nodes in contact with node at time t, once per active contact like ContactIndex.neighbours"""
+        self.advance(t)
+        peers = self.adjacency.get(node)
+        if not peers:
+            return []
+        return [peer for peer, count in peers.items() for _ in range(count)]
+
+    def adjacency_matrix(self, t):
+        """returns the adjacency at time t as a nodes x nodes CSR matrix of the number of active contacts per pair"""
+        columns = self.columns
+        k = self.slice(t)
+        shape = (self.node_count, self.node_count)
+        if self._matrix is None or t < self._matrix_time or columns['event_offsets'][k] > self._matrix_position:
+            indptr, indices = self.snapshot(k)
+            # the matrix gets copies, since sum_duplicates() sorts and merges its arrays in place:
+            self._matrix = sparse.csr_matrix((np.ones(len(indices), dtype=np.int32), np.array(indices),
+                                              np.array(indptr)), shape=shape)
+            self._matrix.sum_duplicates()
+            self._matrix_position = int(columns['event_offsets'][k])
+        end = self._event_end(t)
+        if end > self._matrix_position:
+            node_1 = columns['node_1'][self._matrix_position:end]
+            node_2 = columns['node_2'][self._matrix_position:end]
+            change = np.where(columns['up'][self._matrix_position:end], 1, -1).astype(np.int32)
+            changes = sparse.csr_matrix((np.concatenate([change, change]), (np.concatenate([node_1, node_2]),
+                                                                            np.concatenate([node_2, node_1]))),
+                                        shape=shape)
+            self._matrix = self._matrix + changes
+            self._matrix.eliminate_zeros()
+            self._matrix_position = end
+        self._matrix_time = t
+        return self._matrix
+
+    def recipients(self, nodes, t):
+        """returns the neighbours of every node at time t, once per active contact, as indptr and indices arrays: the
+        neighbours of nodes[i] are indices[indptr[i]:indptr[i + 1]]"""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        known = nodes < self.node_count
+        rows = self.adjacency_matrix(t)[nodes[known]]
+        counts = np.zeros(len(nodes), dtype=np.int64)
+        counts[known] = np.asarray(rows.sum(axis=1)).ravel()
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+        return indptr, np.repeat(rows.indices.astype(np.int64), rows.data)
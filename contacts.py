@@ -0,0 +1,126 @@
+"""Per-node interval index over the contact table.
+
+Answers "which nodes are in range of a node at time t" without a database round trip. The contacts of every node are
+kept in an implicit interval tree: intervals sorted by start time, where the interval at index i is the root of the
+subtree spanning the indices that share all but the lowest trailing one bits of i, and stores the largest end time in
+that subtree so that whole subtrees can be skipped. Nodes whose contacts are all short are answered with two bisections
+over the start times instead.
+
+A contact with start time b and end time e is active at time t if b < t < e.
+"""
+from bisect import bisect_left, bisect_right
+from itertools import chain
+
+import numpy as np
+
+from model import Contact
+
+_SCAN_LEVEL = 3  # subtrees of at most 2 ** (_SCAN_LEVEL + 1) - 1 intervals are scanned linearly
+_SCAN_LIMIT = 64  # candidate ranges of at most this many intervals are scanned without the tree
+
+
+class _NodeIntervals(object):
+    __slots__ = ('starts', 'ends', 'max_ends', 'peers', 'max_length', 'max_level')
+
+    def __init__(self, intervals):
+        intervals.sort()
+        self.starts = [interval[0] for interval in intervals]
+        self.ends = [interval[1] for interval in intervals]
+        self.peers = [interval[2] for interval in intervals]
+        self.max_ends = list(self.ends)
+        self.max_length = max([end - start for start, end, _ in intervals] or [0])
+        self.max_level = self._index()
+
+    def _index(self):
+        """computes the largest end time of every subtree and returns the level of the root"""
+        ends, max_ends = self.ends, self.max_ends
+        n = len(ends)
+        if n == 0:
+            return -1
+        last_i = n - 1 - (n - 1) % 2
+        last = ends[last_i]
+        k = 1
+        while 1 << k <= n:
+            x = 1 << (k - 1)
+            for i in range((x << 1) - 1, n, x << 2):
+                right = max_ends[i + x] if i + x < n else last
+                max_ends[i] = max(ends[i], max_ends[i - x], right)
+            last_i = last_i - x if last_i >> k & 1 else last_i + x
+            if last_i < n and max_ends[last_i] > last:
+                last = max_ends[last_i]
+            k += 1
+        return k - 1
+
+    def overlapping(self, time_start, time_end):
+        """returns the peers of all intervals with start < time_end and end > time_start"""
+        starts, ends, max_ends, peers = self.starts, self.ends, self.max_ends, self.peers
+        # only intervals starting after time_start - max_length can end after time_start:
+        i = bisect_right(starts, time_start - self.max_length)
+        i_end = bisect_left(starts, time_end)
+        if i_end - i <= _SCAN_LIMIT:
+            return [peers[j] for j in range(i, i_end) if ends[j] > time_start]
+        n = len(starts)
+        result = []
+        stack = [(self.max_level, (1 << self.max_level) - 1, False)]
+        while stack:
+            k, x, left_done = stack.pop()
+            if k <= _SCAN_LEVEL:
+                i = x >> k << k
+                i_end = min(i + (1 << (k + 1)) - 1, n)
+                while i < i_end and starts[i] < time_end:
+                    if ends[i] > time_start:
+                        result.append(peers[i])
+                    i += 1
+            elif not left_done:
+                stack.append((k, x, True))
+                y = x - (1 << (k - 1))
+                if y >= n or max_ends[y] > time_start:
+                    stack.append((k - 1, y, False))
+            elif x < n and starts[x] < time_end:
+                if ends[x] > time_start:
+                    result.append(peers[x])
+                stack.append((k - 1, x + (1 << (k - 1)), False))
+        return result
+
+
+class ContactIndex(object):
+    """Index of the contacts of every node, queried by time."""
+
+    def __init__(self, contacts):
+        """contacts is an iterable of (node_1, node_2, time_start, time_end) tuples"""
+        intervals = dict()
+        for node_1, node_2, time_start, time_end in contacts:
+            intervals.setdefault(node_1, []).append((time_start, time_end, node_2))
+            intervals.setdefault(node_2, []).append((time_start, time_end, node_1))
+        self._nodes = {node: _NodeIntervals(node_intervals) for node, node_intervals in intervals.items()}
+
+    @classmethod
+    def from_session(cls, session):
+        """builds the index from the contact table"""
+        return cls(session.query(Contact.node_1, Contact.node_2, Contact.time_start, Contact.time_end).
+                   order_by(Contact.id))
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def neighbours(self, node, t):
+        """returns the nodes in contact with node at time t"""
+        node_intervals = self._nodes.get(node)
+        if node_intervals is None:
+            return []
+        return node_intervals.overlapping(t, t)
+
+    def recipients(self, nodes, t):
+        """returns the neighbours of every node at time t as indptr and indices arrays: the neighbours of nodes[i] are
+        indices[indptr[i]:indptr[i + 1]]"""
+        neighbours = [self.neighbours(node, t) for node in nodes]
+        indptr = np.zeros(len(neighbours) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(node_neighbours) for node_neighbours in neighbours], dtype=np.int64)
+        return indptr, np.fromiter(chain.from_iterable(neighbours), dtype=np.int64, count=indptr.item(-1))
+
+    def neighbours_during(self, node, time_start, time_end):
+        """returns the distinct nodes in contact with node at some point between time_start and time_end"""
+        node_intervals = self._nodes.get(node)
+        if node_intervals is None:
+            return set()
+        return set(node_intervals.overlapping(time_start, time_end))
@@ -0,0 +1,169 @@
+"""Columnar on-disk store for simulation results.
+
+Deliveries of an experiment are kept as one .npy array per column in data/deliveries/experiment_<id>/: broadcast_id
+(int32), recipient_id (int32, NO_RECIPIENT for broadcasts nobody heard) and decrypted (bool), and in store-and-forward
+mode also hops and delay (int32, NO_RECIPIENT for broadcasts nobody heard). The broadcasts of a
+frequency are stored in data/deliveries/broadcasts_<frequency>/ with columns id, sender_id and time (int32, sorted
+by id), so that results can be analyzed without a database; they are replaced when the broadcast table changes. All arrays can be opened memory-mapped.
+"""
+import json
+import os
+from array import array
+
+import numpy as np
+
+NO_RECIPIENT = -1
+
+DELIVERY_COLUMNS = ('broadcast_id', 'recipient_id', 'decrypted')
+FORWARDING_COLUMNS = ('hops', 'delay')
+BROADCAST_COLUMNS = ('id', 'sender_id', 'time')
+
+
+def experiment_path(directory, experiment_id):
+    return os.path.join(directory, "experiment_{}".format(experiment_id))
+
+
+def broadcasts_path(directory, broadcast_frequency):
+    return os.path.join(directory, "broadcasts_{}".format(broadcast_frequency))
+
+
+def _save_column(path, name, values):
+    """writes one column; the file is replaced atomically so that concurrent writers and readers never see a partial
+    array"""
+    filename = os.path.join(path, name + ".npy")
+    temporary = "{}.{}.tmp".format(filename, os.getpid())
+    with open(temporary, 'wb') as f:
+        np.save(f, values)
+    os.replace(temporary, filename)
+
+
+def _load_column(path, name, mmap_mode):
+    return np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+
+
+def write_broadcasts(directory, broadcast_frequency, broadcasts):
+    """stores the engine.BroadcastSchedule of a frequency, replacing the stored one unless it is the same (the
+    broadcast table changes whenever initialize_data.py is run again)"""
+    path = broadcasts_path(directory, broadcast_frequency)
+    order = np.argsort(broadcasts.id, kind='stable')
+    columns = dict(id=broadcasts.id[order].astype(np.int32), sender_id=broadcasts.sender_id[order].astype(np.int32),
+                   time=broadcasts.time[order].astype(np.int32))
+    if all(os.path.exists(os.path.join(path, name + ".npy")) for name in BROADCAST_COLUMNS) and \
+            all(np.array_equal(_load_column(path, name, 'r'), columns[name]) for name in BROADCAST_COLUMNS):
+        return
+    os.makedirs(path, exist_ok=True)
+    for name in BROADCAST_COLUMNS:
+        _save_column(path, name, columns[name])
+
+
+def open_broadcasts(directory, broadcast_frequency, mmap_mode='r'):
+    """returns a dict mapping the broadcast column names to arrays"""
+    path = broadcasts_path(directory, broadcast_frequency)
+    return {name: _load_column(path, name, mmap_mode) for name in BROADCAST_COLUMNS}
+
+
+def open_deliveries(directory, experiment_id, mmap_mode='r'):
+    """returns the parameters of an experiment and a dict mapping the delivery column names to arrays"""
+    path = experiment_path(directory, experiment_id)
+    with open(os.path.join(path, "experiment.json")) as f:
+        params = json.load(f)
+    names = DELIVERY_COLUMNS + (FORWARDING_COLUMNS if params.get("forwarding") else ())
+    return params, {name: _load_column(path, name, mmap_mode) for name in names}
+
+
+def stored_experiments(directory):
+    """returns the ids of all experiments whose deliveries have been stored completely"""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(int(name.split("_", 1)[1]) for name in os.listdir(directory)
+                  if name.startswith("experiment_") and
+                  os.path.exists(os.path.join(directory, name, "experiment.json")))
+
+
+class ColumnarDeliveryWriter(object):
+    """Collects the deliveries of one experiment in compact arrays and stores them when closed.
+
+    At every checkpoint the deliveries collected since the previous one are written as a chunk, and checkpoint.json
+    records the number of chunks and the simulation state. Chunks written after the last recorded checkpoint are
+    discarded when resuming."""
+
+    def __init__(self, directory, experiment, forwarding=False):
+        """with forwarding, the hops and delay of store-and-forward deliveries are stored as well"""
+        self.path = experiment_path(directory, experiment.id)
+        self.params = dict(id=experiment.id, group_limit=experiment.group_limit,
+                           group_size_limit=experiment.group_size_limit,
+                           broadcast_frequency=experiment.broadcast_frequency, forwarding=forwarding)
+        self.forwarding = forwarding
+        self.names = DELIVERY_COLUMNS + (FORWARDING_COLUMNS if forwarding else ())
+        self.chunks = 0
+        self._clear()
+
+    def _clear(self):
+        self.broadcast_id = array('i')
+        self.recipient_id = array('i')
+        self.decrypted = bytearray()
+        self.hops = array('i')
+        self.delay = array('i')
+
+    def _columns(self):
+        columns = dict(broadcast_id=np.frombuffer(self.broadcast_id, dtype=np.int32),
+                       recipient_id=np.frombuffer(self.recipient_id, dtype=np.int32),
+                       decrypted=np.frombuffer(self.decrypted, dtype=np.bool_))
+        if self.forwarding:
+            columns.update(hops=np.frombuffer(self.hops, dtype=np.int32),
+                           delay=np.frombuffer(self.delay, dtype=np.int32))
+        return columns
+
+    def _chunk_name(self, chunk, name):
+        return "chunk_{}_{}".format(chunk, name)
+
+    def write(self, delivery):
+        self.broadcast_id.append(delivery.broadcast_id)
+        self.recipient_id.append(NO_RECIPIENT if delivery.recipient_id is None else delivery.recipient_id)
+        self.decrypted.append(1 if delivery.decrypted else 0)
+        if self.forwarding:
+            self.hops.append(NO_RECIPIENT if delivery.hops is None else delivery.hops)
+            self.delay.append(NO_RECIPIENT if delivery.delay is None else delivery.delay)
+
+    def checkpoint(self, t, state, committed=None):
+        """stores the deliveries collected since the last checkpoint together with the simulation state at time t,
+        then calls committed with t if given"""
+        os.makedirs(self.path, exist_ok=True)
+        for name, values in self._columns().items():
+            _save_column(self.path, self._chunk_name(self.chunks, name), values)
+        self.chunks += 1
+        self._clear()
+        filename = os.path.join(self.path, "checkpoint.json")
+        with open(filename + ".tmp", 'w') as f:
+            json.dump(dict(time=t, state=state, chunks=self.chunks), f)
+        os.replace(filename + ".tmp", filename)
+        if committed is not None:
+            committed(t)
+
+    def resume(self):
+        """returns the time and simulation state of the last checkpoint, or None"""
+        filename = os.path.join(self.path, "checkpoint.json")
+        if not os.path.exists(filename):
+            self.chunks = 0
+            return None
+        with open(filename) as f:
+            checkpoint = json.load(f)
+        self.chunks = checkpoint["chunks"]
+        self._clear()
+        return checkpoint["time"], checkpoint["state"]
+
+    def close(self):
+        os.makedirs(self.path, exist_ok=True)
+        chunks = [{name: _load_column(self.path, self._chunk_name(chunk, name), None) for name in self.names}
+                  for chunk in range(self.chunks)] + [self._columns()]
+        for name in self.names:
+            _save_column(self.path, name, np.concatenate([chunk[name] for chunk in chunks]))
+        # the parameter file marks the experiment as complete, so it is written last:
+        with open(os.path.join(self.path, "experiment.json"), 'w') as f:
+            json.dump(self.params, f)
+        for name in os.listdir(self.path):
+            if name.startswith("chunk_") or name == "checkpoint.json":
+                os.remove(os.path.join(self.path, name))
+
+    def completed(self):
+        pass
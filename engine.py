@@ -0,0 +1,402 @@
+"""Event-driven simulation engine.
+
+Instead of stepping through every second of the simulation and querying the database for broadcasts and contacts, the
+engine loads everything an experiment needs once and jumps from one broadcast event to the next using a priority
+queue.
+
+Broadcasts are kept as a BroadcastSchedule: arrays of times, broadcast ids and sender ids ordered by sender, then time.
+The priority queue holds the next broadcast of every sender, so it stays as small as the number of nodes and the
+schedule arrays can be shared between experiments.
+
+The broadcasts of distinct senders at the same time are delivered together as one step: their recipients are looked up
+at once, the key rotation of all senders is advanced with array operations and whether the recipients can decrypt is
+checked with a single lookup in the sparse membership matrix, so that a step costs a few NumPy calls however many nodes
+there are. Steps of fewer than SMALL_STEP broadcasts, which are the common case with few nodes or sparse broadcasts,
+are delivered one broadcast at a time in plain Python instead, since a few dict and list lookups cost less than the
+fixed overhead of the NumPy calls.
+"""
+import heapq
+import random
+from collections import namedtuple
+
+import numpy as np
+from scipy import sparse
+
+from model import Broadcast, Group, Membership
+
+SMALL_STEP = 32  # steps of fewer broadcasts are delivered one broadcast at a time
+
+# hops and delay are only set by the store-and-forward simulation (see forwarding.py):
+DeliveryRecord = namedtuple('DeliveryRecord', ['broadcast_id', 'sender_id', 'time', 'recipient_id', 'decrypted', 'hops',
+                                               'delay'], defaults=(None, None))
+
+
+BroadcastSchedule = namedtuple('BroadcastSchedule', ['time', 'id', 'sender_id'])
+
+
+def _sorted_schedule(times, ids, sender_ids):
+    """returns a BroadcastSchedule of the given arrays, ordered by sender, then time, then id"""
+    order = np.lexsort((ids, times, sender_ids))
+    return BroadcastSchedule(np.asarray(times, dtype=np.int64)[order], np.asarray(ids, dtype=np.int64)[order],
+                             np.asarray(sender_ids, dtype=np.int64)[order])
+
+
+def load_broadcasts(session, broadcast_frequency, time_limit):
+    """returns the BroadcastSchedule of all broadcasts with the given frequency that happen before time_limit"""
+    rows = np.array(session.query(Broadcast.time, Broadcast.id, Broadcast.sender_id).
+                    filter(Broadcast.frequency == broadcast_frequency, Broadcast.time < time_limit).all(),
+                    dtype=np.int64).reshape(-1, 3)
+    return _sorted_schedule(rows[:, 0], rows[:, 1], rows[:, 2])
+
+
+def load_groups(session, group_limit, group_size_limit):
+    """returns a dict mapping each node to the list of ids of the groups it is a member of"""
+    groups = dict()
+    for node_id, group_id in session.query(Membership.node_id, Membership.group_id).join(Group). \
+            filter(Group.group_limit == group_limit). \
+            filter(Group.group_size_limit == group_size_limit). \
+            order_by(Membership.group_id, Membership.node_id):
+        groups.setdefault(node_id, []).append(group_id)
+    return groups
+
+
+def load_all_groups(session):
+    """returns a dict mapping every (group_limit, group_size_limit) pair to the groups dict of that configuration, as
+    returned by load_groups"""
+    all_groups = dict()
+    for group_limit, group_size_limit, node_id, group_id in \
+            session.query(Group.group_limit, Group.group_size_limit, Membership.node_id, Membership.group_id). \
+            join(Membership, Membership.group_id == Group.id). \
+            order_by(Membership.group_id, Membership.node_id):
+        all_groups.setdefault((group_limit, group_size_limit), dict()).setdefault(node_id, []).append(group_id)
+    return all_groups
+
+
+def _queue_broadcasts(broadcasts, t):
+    """returns a priority queue of the first broadcast of every sender at or after time t, as (time, broadcast_id,
+    sender_id, position, last) tuples, where position is the index of the broadcast in the BroadcastSchedule and last
+    the end of the sender's broadcasts there"""
+    queue = []
+    senders, firsts = np.unique(broadcasts.sender_id, return_index=True)
+    lasts = np.append(firsts[1:], len(broadcasts.sender_id))
+    for sender_id, first, last in zip(senders.tolist(), firsts.tolist(), lasts.tolist()):
+        first += int(np.searchsorted(broadcasts.time[first:last], t))
+        if first < last:
+            queue.append((broadcasts.time.item(first), broadcasts.id.item(first), sender_id, first, last))
+    heapq.heapify(queue)
+    return queue
+
+
+def _broadcast_steps(queue, broadcasts, time_limit, checkpoint=None, checkpoint_interval=None):
+    """generates the broadcasts in queue in order of occurrence until time_limit, grouping the broadcasts of distinct
+    senders at the same time into one (time, broadcast ids, sender ids) step
+
+    checkpoint is called with the time of the next step about every checkpoint_interval seconds, before generating
+    it."""
+    times, ids = broadcasts.time, broadcasts.id
+    next_checkpoint = queue[0][0] + checkpoint_interval if queue and checkpoint and checkpoint_interval else None
+    while queue and queue[0][0] < time_limit:
+        t = queue[0][0]
+        if next_checkpoint is not None and t >= next_checkpoint:
+            checkpoint(t)
+            next_checkpoint = t + checkpoint_interval
+        broadcast_ids, sender_ids, senders = [], [], set()
+        while queue and queue[0][0] == t and queue[0][2] not in senders:
+            _, broadcast_id, sender_id, position, last = queue[0]
+            # replace the event with the sender's next broadcast:
+            position += 1
+            if position < last:
+                heapq.heapreplace(queue, (times.item(position), ids.item(position), sender_id, position, last))
+            else:
+                heapq.heappop(queue)
+            broadcast_ids.append(broadcast_id)
+            sender_ids.append(sender_id)
+            senders.add(sender_id)
+        yield t, broadcast_ids, sender_ids
+
+
+def _membership_keys(matrix):
+    """returns the sorted keys node * columns + column of the members of a CSR membership matrix"""
+    matrix.sum_duplicates()
+    rows = np.repeat(np.arange(matrix.shape[0], dtype=np.int64), np.diff(matrix.indptr))
+    return rows * matrix.shape[1] + matrix.indices
+
+
+def _contains(keys, column_count, nodes, columns):
+    """tells for every pair of nodes and columns (broadcast against each other) whether the node is a member there,
+    given the keys of a membership matrix with column_count columns"""
+    wanted = np.asarray(nodes, dtype=np.int64) * column_count + np.asarray(columns, dtype=np.int64)
+    if len(keys) == 0:
+        return np.zeros(wanted.shape, dtype=bool)
+    return keys[np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)] == wanted
+
+
+def _deliver_step(broadcast_ids, sender_ids, t, indptr, recipients, keys, column_count, group_count, group_start,
+                  group_columns, next_key_index):
+    """returns, for each of several experiments, the deliveries of the broadcasts of a step
+
+    indptr and recipients list the recipients of every broadcast, as returned by the recipients method of the
+    contacts. group_count, group_start and next_key_index are experiments x nodes arrays: the groups of node n in
+    experiment i are the group_count[i, n] membership columns starting at group_columns[group_start[i, n]], and the
+    next one to encrypt with is at next_key_index[i, n], which is advanced for every broadcast that is heard."""
+    senders = np.asarray(sender_ids, dtype=np.int64)
+    counts = np.diff(indptr)
+    known = senders < group_count.shape[1]
+    encrypting = np.zeros((len(group_count), len(senders)), dtype=bool)
+    encrypting[:, known] = group_count[:, senders[known]] > 0
+    encrypting &= counts > 0
+    experiments, positions = encrypting.nonzero()
+    rotating = senders[positions]
+    key_index = next_key_index[experiments, rotating]
+    columns = group_columns[group_start[experiments, rotating] + key_index]
+    next_key_index[experiments, rotating] = (key_index + 1) % group_count[experiments, rotating]
+    # check whether the recipients are in the group of the key, for every heard broadcast of every experiment:
+    pair_counts = counts[positions]
+    firsts = np.repeat(indptr[positions] - (np.cumsum(pair_counts) - pair_counts), pair_counts)
+    decrypted = _contains(keys, column_count, recipients[firsts + np.arange(len(firsts))],
+                          np.repeat(columns, pair_counts)).tolist()
+    recipients, bounds = recipients.tolist(), indptr.tolist()
+    deliveries = []
+    j = 0
+    for experiment_encrypting in encrypting.tolist():
+        experiment_deliveries = []
+        for position, (broadcast_id, sender_id) in enumerate(zip(broadcast_ids, sender_ids)):
+            if experiment_encrypting[position]:
+                first, last = bounds[position], bounds[position + 1]
+                experiment_deliveries.extend(
+                    DeliveryRecord(broadcast_id, sender_id, t, recipient, recipient_decrypted)
+                    for recipient, recipient_decrypted in zip(recipients[first:last], decrypted[j:j + last - first]))
+                j += last - first
+            else:
+                experiment_deliveries.append(DeliveryRecord(broadcast_id, sender_id, t, None, None))
+        deliveries.append(experiment_deliveries)
+    return deliveries
+
+
+class GroupMembership(object):
+    """Group membership of all nodes as a sparse boolean node x group matrix.
+
+    Rows are indexed by node id and columns by the position of a group id in group_ids. The members are also kept as
+    sorted keys node * columns + column, so that checking which of a set of recipients are members of a group is a
+    single binary search, whatever the number of nodes and groups.
+
+    The groups of every node, in the order given, are the group_count[node] columns starting at
+    group_columns[group_start[node]].
+    """
+
+    def __init__(self, groups):
+        """groups is a dict mapping each node to the list of ids of the groups it is a member of"""
+        self.groups = groups
+        self.group_ids = sorted({group_id for node_groups in groups.values() for group_id in node_groups})
+        self.column = {group_id: i for i, group_id in enumerate(self.group_ids)}
+        self.node_count = max(groups) + 1 if groups else 0
+        self.group_count = np.zeros(self.node_count, dtype=np.int64)
+        self.group_start = np.zeros(self.node_count, dtype=np.int64)
+        columns = []
+        for node, node_groups in groups.items():
+            self.group_start[node] = len(columns)
+            self.group_count[node] = len(node_groups)
+            columns.extend(self.column[group_id] for group_id in node_groups)
+        self.group_columns = np.array(columns, dtype=np.int64)
+        rows = np.repeat(np.fromiter(groups, dtype=np.int64, count=len(groups)), self.group_count[list(groups)])
+        self.matrix = sparse.csr_matrix((np.ones(len(columns), dtype=bool), (rows, self.group_columns)),
+                                        shape=(self.node_count, len(self.group_ids)))
+        self.keys = _membership_keys(self.matrix)
+
+    def __contains__(self, node):
+        return node in self.groups
+
+    def __getitem__(self, node):
+        """returns the ids of the groups node is a member of"""
+        return self.groups[node]
+
+    def members(self, nodes, group_id):
+        """returns a boolean array telling which of the given nodes are members of the group"""
+        return _contains(self.keys, len(self.group_ids), nodes, self.column[group_id])
+
+
+class Simulation(object):
+    """Simulates the broadcasts of one experiment in order of occurrence.
+
+    Every sender encrypts its broadcasts with the keys of the groups it belongs to, rotating through them one
+    broadcast at a time, starting from a random group.
+    """
+
+    def __init__(self, broadcasts, contacts, groups, rng=random):
+        self.broadcasts = broadcasts
+        self.seek(0)
+        self.contacts = contacts
+        self.groups = GroupMembership(groups)
+        self.rng = rng
+        # keep track of next group key to use, as positions in the list of groups of every node:
+        self.next_key_index = np.zeros(self.groups.node_count, dtype=np.int64)
+        for node in groups:
+            self.next_key_index[node] = rng.randint(0, len(groups[node]) - 1)
+
+    def seek(self, t):
+        """queues the first broadcast of every sender at or after time t"""
+        self.queue = _queue_broadcasts(self.broadcasts, t)
+
+    def state(self):
+        """returns the key rotation and random generator state as a JSON serializable dict"""
+        return dict(next_key_index={node: self.next_key_index.item(node) for node in self.groups.groups},
+                    rng=self.rng.getstate())
+
+    def restore(self, state):
+        """restores a state returned by state()"""
+        for node, key_index in state["next_key_index"].items():
+            self.next_key_index[int(node)] = key_index
+        version, internal_state, gauss_next = state["rng"]
+        self.rng.setstate((version, tuple(internal_state), gauss_next))
+
+    def recipients(self, sender_id, t):
+        """returns the nodes in range of sender_id at time t"""
+        return self.contacts.neighbours(sender_id, t)
+
+    def recipients_step(self, sender_ids, t):
+        """returns the nodes in range of every sender at time t as indptr and indices arrays: the recipients of
+        sender_ids[i] are indices[indptr[i]:indptr[i + 1]]"""
+        return self.contacts.recipients(sender_ids, t)
+
+    def next_key(self, sender_id):
+        """returns the group key of the next broadcast of sender_id and moves on to the following one"""
+        sender_groups = self.groups[sender_id]
+        key_index = self.next_key_index.item(sender_id)
+        self.next_key_index[sender_id] = (key_index + 1) % len(sender_groups)
+        return sender_groups[key_index]
+
+    def _deliver_one(self, broadcast_id, sender_id, t):
+        """returns the deliveries of a single broadcast"""
+        recipients = self.recipients(sender_id, t)
+        if len(recipients) == 0 or sender_id not in self.groups:
+            return [DeliveryRecord(broadcast_id, sender_id, t, None, None)]
+        group_key = self.next_key(sender_id)
+        groups = self.groups.groups
+        return [DeliveryRecord(broadcast_id, sender_id, t, recipient, group_key in groups.get(recipient, ()))
+                for recipient in recipients]
+
+    def deliver_step(self, broadcast_ids, sender_ids, t):
+        """returns the deliveries of the broadcasts of distinct senders at time t"""
+        if len(sender_ids) < SMALL_STEP:
+            deliveries = []
+            for broadcast_id, sender_id in zip(broadcast_ids, sender_ids):
+                deliveries.extend(self._deliver_one(broadcast_id, sender_id, t))
+            return deliveries
+        indptr, recipients = self.recipients_step(sender_ids, t)
+        groups = self.groups
+        return _deliver_step(broadcast_ids, sender_ids, t, indptr, recipients, groups.keys, len(groups.group_ids),
+                             groups.group_count[None], groups.group_start[None], groups.group_columns,
+                             self.next_key_index[None])[0]
+
+    def run(self, time_limit, checkpoint=None, checkpoint_interval=None):
+        """generates the deliveries of all queued broadcasts sent before time_limit, in order of occurrence
+
+        If checkpoint is given, it is called with a time t about every checkpoint_interval simulated seconds, once the
+        deliveries of all broadcasts before t have been generated and consumed and before any later one is."""
+        for t, broadcast_ids, sender_ids in _broadcast_steps(self.queue, self.broadcasts, time_limit, checkpoint,
+                                                             checkpoint_interval):
+            for delivery in self.deliver_step(broadcast_ids, sender_ids, t):
+                yield delivery
+
+
+class SimulationBatch(object):
+    """Simulates several experiments with the same broadcasts and contacts but different groups in a single pass.
+
+    The recipients of the broadcasts are looked up once, and whether they can decrypt them is checked for all
+    experiments at once in the membership matrices of all experiments side by side. The key rotation of every
+    experiment is kept as one row of an experiments x nodes array, so its deliveries are the same as when simulated
+    alone; state(i) copies it back into the Simulation of experiment i.
+    """
+
+    def __init__(self, simulations):
+        """simulations are the Simulations of the experiments, which must share their broadcasts and contacts"""
+        self.simulations = simulations
+        self.broadcasts = simulations[0].broadcasts
+        self.contacts = simulations[0].contacts
+        memberships = [simulation.groups for simulation in simulations]
+        node_count = max(groups.node_count for groups in memberships)
+        self.offsets = np.cumsum([0] + [len(groups.group_ids) for groups in memberships]).tolist()
+        matrices = []
+        for groups in memberships:
+            matrix = groups.matrix.copy()
+            matrix.resize((node_count, matrix.shape[1]))
+            matrices.append(matrix)
+        self.matrix = sparse.hstack(matrices, format='csr')
+        self.keys = _membership_keys(self.matrix)
+        shape = (len(simulations), node_count)
+        self.group_count = np.zeros(shape, dtype=np.int64)
+        self.group_start = np.zeros(shape, dtype=np.int64)
+        self.next_key_index = np.zeros(shape, dtype=np.int64)
+        group_columns = []
+        start = 0
+        for i, (simulation, groups) in enumerate(zip(simulations, memberships)):
+            self.group_count[i, :groups.node_count] = groups.group_count
+            self.group_start[i, :groups.node_count] = groups.group_start + start
+            self.next_key_index[i, :groups.node_count] = simulation.next_key_index
+            group_columns.append(groups.group_columns + self.offsets[i])
+            start += len(groups.group_columns)
+        self.group_columns = np.concatenate(group_columns)
+        self.seek(0)
+
+    def seek(self, t):
+        """queues the first broadcast of every sender at or after time t"""
+        self.queue = _queue_broadcasts(self.broadcasts, t)
+
+    def state(self, i):
+        """returns the state of experiment i, as returned by Simulation.state"""
+        simulation = self.simulations[i]
+        simulation.next_key_index[:] = self.next_key_index[i, :len(simulation.next_key_index)]
+        return simulation.state()
+
+    def recipients(self, sender_id, t):
+        """returns the nodes in range of sender_id at time t"""
+        return self.contacts.neighbours(sender_id, t)
+
+    def recipients_step(self, sender_ids, t):
+        """returns the nodes in range of every sender at time t, as Simulation.recipients_step"""
+        return self.contacts.recipients(sender_ids, t)
+
+    def _deliver_one(self, broadcast_id, sender_id, t):
+        """returns the deliveries of a single broadcast in all experiments, as (index of the experiment, delivery)
+        pairs"""
+        recipients = self.recipients(sender_id, t)
+        unheard = DeliveryRecord(broadcast_id, sender_id, t, None, None)
+        if len(recipients) == 0:
+            return [(i, unheard) for i in range(len(self.simulations))]
+        deliveries = []
+        known = sender_id < self.next_key_index.shape[1]
+        for i, simulation in enumerate(self.simulations):
+            key_count = self.group_count.item(i, sender_id) if known else 0
+            if key_count == 0:
+                deliveries.append((i, unheard))
+                continue
+            key_index = self.next_key_index.item(i, sender_id)
+            self.next_key_index[i, sender_id] = (key_index + 1) % key_count
+            groups = simulation.groups.groups
+            group_key = groups[sender_id][key_index]
+            deliveries.extend((i, DeliveryRecord(broadcast_id, sender_id, t, recipient,
+                                                 group_key in groups.get(recipient, ())))
+                              for recipient in recipients)
+        return deliveries
+
+    def deliver_step(self, broadcast_ids, sender_ids, t):
+        """returns the deliveries of the broadcasts of distinct senders at time t in all experiments, as (index of the
+        experiment, delivery) pairs"""
+        if len(sender_ids) < SMALL_STEP:
+            deliveries = []
+            for broadcast_id, sender_id in zip(broadcast_ids, sender_ids):
+                deliveries.extend(self._deliver_one(broadcast_id, sender_id, t))
+            return deliveries
+        indptr, recipients = self.recipients_step(sender_ids, t)
+        deliveries = _deliver_step(broadcast_ids, sender_ids, t, indptr, recipients, self.keys, self.offsets[-1],
+                                   self.group_count, self.group_start, self.group_columns, self.next_key_index)
+        return [(i, delivery) for i, experiment_deliveries in enumerate(deliveries)
+                for delivery in experiment_deliveries]
+
+    def run(self, time_limit, checkpoint=None, checkpoint_interval=None):
+        """generates the (index of the experiment, delivery) pairs of all queued broadcasts sent before time_limit, in
+        order of occurrence; checkpoint is called as by Simulation.run"""
+        for t, broadcast_ids, sender_ids in _broadcast_steps(self.queue, self.broadcasts, time_limit, checkpoint,
+                                                             checkpoint_interval):
+            for delivery in self.deliver_step(broadcast_ids, sender_ids, t):
+                yield delivery
@@ -0,0 +1,138 @@
+"""Multi-hop store-and-forward simulation.
+
+Every node keeps a buffer of the frames it received and could decrypt (and, with forward_undecryptable, of the frames
+it could not decrypt). A node that stores a frame passes it on to every node in range at that moment and, later, to
+every node it comes into contact with, until the frame is older than ttl seconds or has been pushed out of the buffer,
+which holds at most buffer_size frames and drops the oldest first. Forwarding takes no time, so a broadcast spreads
+through all nodes connected to the sender at once. Every delivery records the number of hops the frame travelled and
+its delay, i.e. the time since it was broadcast.
+
+A node receives every broadcast at most once: the nodes a frame has reached are kept as a bit set in a single integer
+per broadcast, which is dropped once the frame expires. A broadcast that reached nobody until it expired is recorded as
+unheard then.
+
+Contacts coming up are taken from the events of a contact_timeline.ContactTimeline. Unlike the single-hop simulation,
+runs are not checkpointed: a frame may still be delivered long after it was broadcast, so an interrupted run starts
+over.
+"""
+import heapq
+import random
+from collections import deque
+
+from engine import DeliveryRecord, Simulation
+
+
+class ForwardingSimulation(Simulation):
+    """Simulates the broadcasts of one experiment with store-and-forward delivery over multiple hops."""
+
+    def __init__(self, broadcasts, contacts, groups, rng=random, ttl=None, buffer_size=None,
+                 forward_undecryptable=False):
+        """contacts is a ContactTimeline; ttl and buffer_size may be None for no limit"""
+        super().__init__(broadcasts, contacts, groups, rng)
+        self.ttl = ttl
+        self.buffer_size = buffer_size
+        self.forward_undecryptable = forward_undecryptable
+        # frames (broadcast_id, sender_id, time, group_key) with the number of hops they took, per node:
+        self.buffers = dict()
+        # nodes reached by every unexpired broadcast, as a bit set:
+        self.reached = dict()
+        # unexpired frames in order of broadcast time:
+        self.pending = deque()
+
+    def _store(self, node, frame, hops):
+        buffer = self.buffers.get(node)
+        if buffer is None:
+            buffer = self.buffers[node] = deque(maxlen=self.buffer_size)
+        buffer.append((frame, hops))
+
+    def _flood(self, t, frame, candidates):
+        """delivers frame to the (node, hops) candidates it has not reached yet and passes it on from every node that
+        stores it, returning the deliveries"""
+        broadcast_id, sender_id, time, group_key = frame
+        reached = self.reached[broadcast_id]
+        records = []
+        while candidates:
+            receivers = []
+            for node, hops in candidates:
+                if not reached >> node & 1:
+                    reached |= 1 << node
+                    receivers.append((node, hops))
+            decrypted = self.groups.members([node for node, _ in receivers], group_key).tolist()
+            candidates = []
+            for (node, hops), node_decrypted in zip(receivers, decrypted):
+                records.append(DeliveryRecord(broadcast_id, sender_id, time, node, node_decrypted, hops, t - time))
+                if node_decrypted or self.forward_undecryptable:
+                    self._store(node, frame, hops)
+                    candidates.extend((peer, hops + 1) for peer in self.recipients(node, t))
+        self.reached[broadcast_id] = reached
+        return records
+
+    def deliver(self, broadcast_id, sender_id, t):
+        """returns the deliveries of a broadcast to the nodes connected to the sender, over any number of hops"""
+        if sender_id not in self.groups:
+            return [DeliveryRecord(broadcast_id, sender_id, t, None, None)]
+        frame = (broadcast_id, sender_id, t, self.next_key(sender_id))
+        self.reached[broadcast_id] = 1 << sender_id
+        self.pending.append(frame)
+        self._store(sender_id, frame, 0)
+        return self._flood(t, frame, [(node, 1) for node in self.recipients(sender_id, t)])
+
+    def contact_up(self, t, node_1, node_2):
+        """returns the deliveries of the buffered frames the two nodes of a contact starting at t exchange"""
+        records = []
+        for node, peer in ((node_1, node_2), (node_2, node_1)):
+            buffer = self.buffers.get(node)
+            if not buffer:
+                continue
+            # expired frames are no longer in reached:
+            while buffer and buffer[0][0][0] not in self.reached:
+                buffer.popleft()
+            for frame, hops in list(buffer):
+                reached = self.reached.get(frame[0])
+                if reached is not None and not reached >> peer & 1:
+                    records.extend(self._flood(t, frame, [(peer, hops + 1)]))
+        return records
+
+    def expire(self, t=None):
+        """drops the frames broadcast more than ttl seconds before t, or all frames if t is None, and returns the
+        unheard records of those that reached nobody"""
+        records = []
+        pending = self.pending
+        while pending and (t is None or self.ttl is not None and t - pending[0][2] > self.ttl):
+            broadcast_id, sender_id, time, _ = pending.popleft()
+            if self.reached.pop(broadcast_id) == 1 << sender_id:
+                records.append(DeliveryRecord(broadcast_id, sender_id, time, None, None))
+        return records
+
+    def run(self, time_limit, checkpoint=None, checkpoint_interval=None):
+        """generates the deliveries of all queued broadcasts sent before time_limit, forwarding frames on the contacts
+        that come up before time_limit
+
+        checkpoint and checkpoint_interval are ignored, since store-and-forward runs are not checkpointed."""
+        queue = self.queue
+        times, ids = self.broadcasts.time, self.broadcasts.id
+        events = self.contacts.columns
+        ups = events['up'].nonzero()[0]
+        up_times, up_node_1, up_node_2 = events['time'][ups], events['node_1'][ups], events['node_2'][ups]
+        u = 0
+        while True:
+            next_time = queue[0][0] if queue and queue[0][0] < time_limit else time_limit
+            # contacts that come up at the time of a broadcast are not in range when it is sent:
+            while u < len(up_times) and up_times.item(u) < next_time:
+                t = up_times.item(u)
+                for delivery in self.expire(t) + self.contact_up(t, up_node_1.item(u), up_node_2.item(u)):
+                    yield delivery
+                u += 1
+            if next_time == time_limit:
+                break
+            t, broadcast_id, sender_id, position, last = queue[0]
+            # replace the event with the sender's next broadcast:
+            position += 1
+            if position < last:
+                heapq.heapreplace(queue, (times.item(position), ids.item(position), sender_id, position, last))
+            else:
+                heapq.heappop(queue)
+            for delivery in self.expire(t) + self.deliver(broadcast_id, sender_id, t):
+                yield delivery
+        for delivery in self.expire():
+            yield delivery
@@ -1,129 +1,212 @@
-from random import sample, choice
+import random
+import time
+from multiprocessing import Pool
 
 import networkx as nx
+import numpy as np
 from numpy import random as nprandom
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import func, text
 from model import *
-import yaml
 
-from bootstrap import get_mobility_session
+from bootstrap import create_schema, get_engine, get_mobility_session, insert_rows, load_config
+from contact_timeline import ContactTimeline
+from mobility_cache import load_mobility_trace
 
 
-def parse_mobility_data(session, mobility_data_file):
+def _reset_id_sequence(session, table):
+    """moves the id sequence of a postgres table past the ids that were inserted explicitly"""
+    if session.bind.dialect.name == 'postgresql':
+        session.execute(text("SELECT setval(pg_get_serial_sequence('\"{0}\"', 'id'), "
+                             "(SELECT coalesce(max(id), 0) + 1 FROM \"{0}\"), false)".format(table.name)))
+
+
+def parse_mobility_data(session, mobility_data_file, chunk_size=100000, cache_directory='data/cache'):
+    """reads the mobility input, stores its nodes and contacts and returns the contact graph
+
+    The input is parsed in chunks into NumPy arrays, which are cached in cache_directory and reused as long as the
+    input file does not change (see mobility_cache.py). Node ids are assigned in order of first appearance, and the
+    contacts are written in chunks of chunk_size rows with a single bulk insert (COPY on postgres) and commit each."""
     G = nx.Graph()
-    with open(mobility_data_file) as mobility_data:
-        nodes = dict()
-        count = 0
-        for line in mobility_data:
-            line = line[:-1].split(" ")
-            x, y = [int(s) for s in line[:2]]
-            if x not in nodes:
-                new_node = Node()
-                session.add(new_node)
-                session.commit()
-                nodes[x] = new_node
-                G.add_node(new_node.id)
-            if y not in nodes:
-                new_node = Node()
-                session.add(new_node)
-                session.commit()
-                nodes[y] = new_node
-                G.add_node(new_node.id)
-            intervals = line[2:]
-            for interval in intervals:
-                t1, t2 = [int(float(t)) for t in interval.split("*")]
-                new_contact = Contact(node_1=nodes[x].id, node_2=nodes[y].id, time_start=t1, time_end=t2)
-                session.add(new_contact)
-                session.commit()
-            G.add_edge(nodes[x].id, nodes[y].id)
+    start_time = time.time()
+    trace = load_mobility_trace(mobility_data_file, cache_directory)
+    next_node_id = (session.query(func.max(Node.id)).scalar() or 0) + 1
+
+    # number the distinct node ids of the input in order of first appearance:
+    input_ids, first, inverse = np.unique(trace.pairs, return_index=True, return_inverse=True)
+    rank = np.empty(len(input_ids), dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(len(input_ids))
+    pairs = (next_node_id + rank[inverse]).reshape(-1, 2)
+    node_ids = list(range(next_node_id, next_node_id + len(input_ids)))
+    G.add_nodes_from(node_ids)
+    G.add_edges_from(pairs.tolist())
+    insert_rows(session, Node.__table__, ["id"], [(node_id,) for node_id in node_ids])
+
+    # the contacts of line i are offsets[i]:offsets[i + 1]:
+    offsets = np.concatenate([[0], np.cumsum(trace.counts)])
+    contact_count = int(offsets[-1])
+    for chunk in range(0, contact_count, chunk_size):
+        chunk_end = min(chunk + chunk_size, contact_count)
+        lines = np.searchsorted(offsets, np.arange(chunk, chunk_end), 'right') - 1
+        insert_rows(session, Contact.__table__, ["node_1", "node_2", "time_start", "time_end"],
+                    list(zip(pairs[lines, 0].tolist(), pairs[lines, 1].tolist(),
+                             trace.time_start[chunk:chunk_end].tolist(), trace.time_end[chunk:chunk_end].tolist())))
+        session.commit()
+    _reset_id_sequence(session, Node.__table__)
     session.commit()
+
+    node_count = len(node_ids)
+    elapsed = time.time() - start_time
+    print("loaded {} nodes and {} contacts in {:.1f}s ({:.0f} rows/s)".format(
+        node_count, contact_count, elapsed, (node_count + contact_count) / max(elapsed, 1e-9)))
     return G
 
 
-def create_baseline_group(session, node_count):
-    nodes = session.query(Node).all()
-    new_group = Group(group_limit=1, group_size_limit=node_count)
-    session.add(new_group)
+def write_groups(session, group_limit, group_size_limit, groups):
+    """stores groups (lists of node ids) and their memberships with one bulk insert each"""
+    first_id = (session.query(func.max(Group.id)).scalar() or 0) + 1
+    group_ids = range(first_id, first_id + len(groups))
+    insert_rows(session, Group.__table__, ["id", "group_limit", "group_size_limit"],
+                [(group_id, group_limit, group_size_limit) for group_id in group_ids])
+    insert_rows(session, Membership.__table__, ["group_id", "node_id"],
+                [(group_id, n) for group_id, group in zip(group_ids, groups) for n in group])
+    _reset_id_sequence(session, Group.__table__)
     session.commit()
-    for node in nodes:
-        membership = Membership(group_id=new_group.id, node_id=node.id)
-        session.add(membership)
-        session.commit()
 
 
-def create_group(session, graph, group_limit, group_size_limit):
+def create_baseline_group(session, node_count):
+    node_ids = [node_id for node_id, in session.query(Node.id).order_by(Node.id)]
+    write_groups(session, 1, node_count, [node_ids])
+
+
+def _maximal(cliques):
+    """returns the cliques that are not a proper subset of another one"""
+    return [c for c in cliques if not any(c < other for other in cliques)]
+
+
+def form_groups(graph, group_limit, group_size_limit, rng=random):
+    """returns the groups (lists of node ids) formed from the cliques of graph
+
+    Until no two nodes are left, a random node is picked and groups are formed from the maximal cliques containing it,
+    largest first: each group is the node plus a random sample of the rest of the clique, limited to group_size_limit
+    members, and is only formed if none of its members is already in group_limit groups. Nodes in group_limit groups
+    and nodes without neighbours are removed from the graph.
+
+    The maximal cliques of the graph are enumerated once. After removing nodes, the maximal cliques containing a node
+    are the maximal ones among its original maximal cliques minus the removed nodes."""
+    cliques = [frozenset(c) for c in nx.find_cliques(graph) if len(c) > 1]
+    cliques_of = {node: [] for node in graph}
+    for clique in cliques:
+        for n in clique:
+            cliques_of[n].append(clique)
+    # remaining nodes, kept in a list for random picks and a dict of positions for removal:
+    remaining = list(graph)
+    position = {node: i for i, node in enumerate(remaining)}
+
+    def remove(n):
+        last = remaining.pop()
+        if last != n:
+            remaining[position[n]] = last
+            position[last] = position[n]
+        del position[n]
+
     nodes = dict()
-    while (len(graph) > 1):
-        node = choice(graph.nodes())
+    groups = []
+    while len(remaining) > 1:
+        node = rng.choice(remaining)
         node_reached_group_limit = False
-        long_cliques = [c for c in nx.cliques_containing_node(graph, nodes=[node])[node] if len(c) > 1]
+        long_cliques = _maximal({frozenset(n for n in c if n in position) for c in cliques_of[node]})
+        long_cliques = [c for c in long_cliques if len(c) > 1]
         if len(long_cliques) == 0:
-            graph.remove_node(node)
+            remove(node)
             continue
-        cliques = sorted(long_cliques, key=lambda x: len(x), reverse=True)
-        for clique in cliques:
-            if len(clique) < 2:
-                break
+        for clique in sorted(long_cliques, key=len, reverse=True):
             l = min(len(clique), group_size_limit)
-            clique.remove(node)
-            group = sample(clique, l - 1) + [node]
-            available = True
+            group = rng.sample(sorted(clique - {node}), l - 1) + [node]
+            if any(nodes.get(n, 0) == group_limit for n in group):
+                continue
+            groups.append(group)
             for n in group:
-                nodes.setdefault(n, 0)
+                nodes[n] = nodes.get(n, 0) + 1
                 if nodes[n] == group_limit:
-                    available = False
-                    break
-            if available:
-                new_group = Group(group_limit=group_limit, group_size_limit=group_size_limit)
-                session.add(new_group)
-                session.commit()
-                for n in group:
-                    membership = Membership(group_id=new_group.id, node_id=n)
-                    session.add(membership)
-                    session.commit()
-                    nodes[n] += 1
-                    if nodes[n] == group_limit:
-                        graph.remove_node(n)
-                        if n == node:
-                            node_reached_group_limit = True
+                    remove(n)
+                    if n == node:
+                        node_reached_group_limit = True
             if node_reached_group_limit:
                 break
-    return
+    return groups
 
 
-def generate_broadcasts(session, broadcast_frequency, total_time):
-    nodes = session.query(Node).all()
-    for node in nodes:
-        t = nprandom.randint(0, broadcast_frequency)
-        while t <= total_time - broadcast_frequency:
-            new_broadcast = Broadcast(frequency=broadcast_frequency, time=t, sender_id=node.id)
-            session.add(new_broadcast)
-            session.commit()
-            t += broadcast_frequency
+def create_group(session, graph, group_limit, group_size_limit):
+    write_groups(session, group_limit, group_size_limit, form_groups(graph, group_limit, group_size_limit))
+
+
+def _form_groups(args):
+    graph, group_limit, group_size_limit, seed = args
+    return form_groups(graph, group_limit, group_size_limit, random.Random(seed))
+
+
+def create_groups(session, graph, group_limits, group_sizes, seed=None, processes=None):
+    """forms the groups of all (group_limit, group_size_limit) combinations in parallel and stores them
+
+    Every combination is formed with its own generator, seeded from seed if given and otherwise with a seed drawn
+    here: forked workers inherit the same random state, so they would all draw the same numbers."""
+    combinations = [(group_limit, group_size_limit) for group_limit in group_limits for group_size_limit in group_sizes]
+    seeds = [random.getrandbits(64) if seed is None else "{}-{}-{}".format(seed, group_limit, group_size_limit)
+             for group_limit, group_size_limit in combinations]
+    pool = Pool(processes)
+    all_groups = pool.map(_form_groups, [(graph, group_limit, group_size_limit, task_seed)
+                                         for (group_limit, group_size_limit), task_seed in zip(combinations, seeds)])
+    pool.close()
+    pool.join()
+    for (group_limit, group_size_limit), groups in zip(combinations, all_groups):
+        write_groups(session, group_limit, group_size_limit, groups)
+
+
+def broadcast_schedule(node_ids, broadcast_frequency, total_time, seed=None):
+    """returns the (time, sender id) arrays of the broadcasts of the given nodes
+
+    Every node starts broadcasting at a random time in [0, broadcast_frequency) and then broadcasts every
+    broadcast_frequency seconds until total_time - broadcast_frequency. The broadcasts are ordered by node, then time.
+    The random start times are drawn from numpy's global generator, or from a generator seeded with seed if given."""
+    rng = nprandom if seed is None else nprandom.RandomState(seed)
+    node_ids = np.asarray(node_ids, dtype=np.int64)
+    phases = rng.randint(0, broadcast_frequency, size=len(node_ids))
+    counts = np.maximum((total_time - broadcast_frequency - phases) // broadcast_frequency + 1, 0)
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    times = np.repeat(phases, counts) + (np.arange(counts.sum()) - first) * broadcast_frequency
+    return times, np.repeat(node_ids, counts)
+
+
+def generate_broadcasts(session, broadcast_frequency, total_time, seed=None):
+    node_ids = [node_id for node_id, in session.query(Node.id).order_by(Node.id)]
+    times, sender_ids = broadcast_schedule(node_ids, broadcast_frequency, total_time, seed)
+    rows = zip([broadcast_frequency] * len(times), times.tolist(), sender_ids.tolist())
+    insert_rows(session, Broadcast.__table__, ["frequency", "time", "sender_id"], list(rows))
+    session.commit()
 
 
 if __name__ == '__main__':
+    create_schema(get_engine())
     session = get_mobility_session()
 
+    data_dict = load_config()
     mobility_data_file = "input/nokia_trimmed.linkdump"
-    graph = parse_mobility_data(session, mobility_data_file)
-
-    with open("config.yaml", "r") as config_file:
-        yaml_data = config_file.read()
+    graph = parse_mobility_data(session, mobility_data_file, cache_directory=data_dict.get("cache_directory",
+                                                                                          "data/cache"))
 
-    data_dict = yaml.load(yaml_data)
+    ContactTimeline.from_session(session, data_dict.get("timeline_slice", 3600)). \
+        save(data_dict.get("contact_timeline", "data/timeline"))
     group_limits = data_dict["group_limits"]
     group_sizes = data_dict["group_sizes"]
     broadcast_freqs = data_dict["broadcast_freqs"]
     node_count = data_dict["node_count"]
     total_time = data_dict["total_time"]
+    seed = data_dict.get("seed")
 
     #create_baseline_group(session)
     create_baseline_group(session, node_count)
 
-    for group_limit in group_limits:
-        for group_size_limit in group_sizes:
-            create_group(session, graph.copy(), group_limit, group_size_limit)
+    create_groups(session, graph, group_limits, group_sizes, seed)
 
     for broadcast_frequency in broadcast_freqs:
-        generate_broadcasts(session, broadcast_frequency, total_time)
+        generate_broadcasts(session, broadcast_frequency, total_time, seed)
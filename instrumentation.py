@@ -0,0 +1,157 @@
+"""Instrumentation of simulation runs.
+
+An Instrumentation collects per-phase timers and counters of one experiment, prints its progress and writes a
+structured log to <directory>/metrics_<experiment id>.jsonl: one JSON record per progress report and a summary record
+at the end. It can also profile the run with cProfile.
+
+Nothing is instrumented unless enabled: the instrument and wrap_writer methods replace the hot methods of a simulation
+and writer with timed wrappers on the instance, so uninstrumented runs execute exactly the same code as before.
+"""
+import cProfile
+import json
+import os
+import time
+from collections import defaultdict
+
+from sqlalchemy import event
+
+
+class _TimedWriter(object):
+    """Delivery writer proxy that times and counts the calls to the wrapped writer."""
+
+    def __init__(self, writer, instrumentation):
+        self.writer = writer
+        self.instrumentation = instrumentation
+
+    def write(self, delivery):
+        start = time.perf_counter()
+        self.writer.write(delivery)
+        self.instrumentation.timers["write"] += time.perf_counter() - start
+        self.instrumentation.counters["deliveries"] += 1
+
+    def checkpoint(self, t, state, committed=None):
+        start = time.perf_counter()
+        self.writer.checkpoint(t, state, committed)
+        self.instrumentation.timers["checkpoint"] += time.perf_counter() - start
+        self.instrumentation.counters["checkpoints"] += 1
+
+    def resume(self):
+        return self.writer.resume()
+
+    def restore(self, t):
+        return self.writer.restore(t)
+
+    def close(self):
+        start = time.perf_counter()
+        self.writer.close()
+        self.instrumentation.timers["close"] += time.perf_counter() - start
+
+    def completed(self):
+        self.writer.completed()
+
+
+class Instrumentation(object):
+    """Timers, counters, progress reports and optional profile of the simulation of one experiment."""
+
+    def __init__(self, experiment_id, time_limit, directory='data/metrics', progress_interval=60, profile=False):
+        self.experiment_id = experiment_id
+        self.time_limit = time_limit
+        self.directory = directory
+        self.progress_interval = progress_interval
+        self.timers = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.profiler = cProfile.Profile() if profile else None
+        self._engine = None
+        self._log = None
+
+    def _count_statement(self, *args):
+        self.counters["db_round_trips"] += 1
+
+    def watch(self, engine):
+        """counts the statements sent to the database through engine"""
+        self._engine = engine
+        event.listen(engine, "before_cursor_execute", self._count_statement)
+
+    def _time_contacts(self, recipients, count):
+        def timed_recipients(sender, t):
+            start = time.perf_counter()
+            result = recipients(sender, t)
+            self.timers["contacts"] += time.perf_counter() - start
+            self.counters["contacts_scanned"] += count(result)
+            return result
+        return timed_recipients
+
+    def _time_deliveries(self, deliver, count):
+        def timed_deliver(broadcast, sender, t):
+            contacts = self.timers["contacts"]
+            start = time.perf_counter()
+            result = deliver(broadcast, sender, t)
+            now = time.perf_counter()
+            # the contact lookups within deliver are timed separately:
+            self.timers["deliver"] += now - start - (self.timers["contacts"] - contacts)
+            self.counters["broadcasts"] += count(broadcast)
+            if now >= self._next_report:
+                self.report(t, now)
+            return result
+        return timed_deliver
+
+    def instrument(self, simulation):
+        """times the contact lookups and deliveries of simulation and reports progress
+
+        Both the per broadcast methods (recipients, deliver) and those handling all broadcasts of a time step at once
+        (recipients_step, deliver_step) are timed, whichever the simulation has."""
+        if hasattr(simulation, 'recipients'):
+            simulation.recipients = self._time_contacts(simulation.recipients, len)
+        if hasattr(simulation, 'recipients_step'):
+            simulation.recipients_step = self._time_contacts(simulation.recipients_step, lambda result: len(result[1]))
+        if hasattr(simulation, 'deliver'):
+            simulation.deliver = self._time_deliveries(simulation.deliver, lambda broadcast_id: 1)
+        if hasattr(simulation, 'deliver_step'):
+            simulation.deliver_step = self._time_deliveries(simulation.deliver_step, len)
+        return simulation
+
+    def wrap_writer(self, writer):
+        return _TimedWriter(writer, self)
+
+    def start(self, start_time=0):
+        """starts measuring the run of a simulation from simulated time start_time"""
+        os.makedirs(self.directory, exist_ok=True)
+        self._log = open(os.path.join(self.directory, "metrics_{}.jsonl".format(self.experiment_id)), 'a')
+        self._start_time = start_time
+        self._wall_start = time.perf_counter()
+        self._next_report = self._wall_start + self.progress_interval
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def _record(self, kind, **values):
+        record = dict(kind=kind, experiment=self.experiment_id, time=time.time(),
+                      wall_time=time.perf_counter() - self._wall_start, timers=dict(self.timers),
+                      counters=dict(self.counters))
+        record.update(values)
+        self._log.write(json.dumps(record) + "\n")
+        self._log.flush()
+        return record
+
+    def report(self, t, now=None):
+        """prints and logs the progress of the simulation at simulated time t"""
+        now = time.perf_counter() if now is None else now
+        elapsed = now - self._wall_start
+        rate = (t - self._start_time) / elapsed if elapsed > 0 else 0
+        eta = (self.time_limit - t) / rate if rate > 0 else None
+        self._record("progress", simulated_time=t, simulated_per_wall_second=rate, eta=eta)
+        print("{}: at {}/{} simulated seconds, {:.0f} simulated seconds per second, eta {}".format(
+            self.experiment_id, t, self.time_limit, rate, "{:.0f}s".format(eta) if eta is not None else "unknown"))
+        self._next_report = now + self.progress_interval
+
+    def finish(self):
+        """stops measuring, writes the summary record and the profile, and returns the summary"""
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(os.path.join(self.directory, "profile_{}.prof".format(self.experiment_id)))
+        if self._engine is not None:
+            event.remove(self._engine, "before_cursor_execute", self._count_statement)
+        elapsed = time.perf_counter() - self._wall_start
+        summary = self._record("summary", broadcasts_per_second=self.counters["broadcasts"] / elapsed
+                               if elapsed > 0 else None)
+        self._log.close()
+        return summary
@@ -0,0 +1,126 @@
+"""Binary cache of parsed mobility traces.
+
+A linkdump file has one line per pair of nodes that met: the two node ids followed by the contact intervals of the
+pair as start*end. Parsing it once yields a MobilityTrace of NumPy arrays, which is stored as .npy files in
+<cache directory>/<file name>.<sha256 of the file>/ and opened memory-mapped, also right after parsing: the file is
+parsed in chunks of lines that are appended to the cache, so the whole trace is never held in memory. A changed input
+file has a different hash, so it is parsed again and the cache of its previous content is removed.
+"""
+import hashlib
+import itertools
+import os
+import shutil
+import tempfile
+from array import array
+from collections import namedtuple
+
+import numpy as np
+
+# pairs: the two node ids of every line (lines x 2), counts: the number of contacts on every line, time_start and
+# time_end: the contacts of all lines, in order of appearance
+MobilityTrace = namedtuple('MobilityTrace', ['pairs', 'counts', 'time_start', 'time_end'])
+
+_COPY_BLOCK = 2 ** 20  # values copied at a time from the raw files into the .npy files
+
+
+def file_hash(path, block_size=2 ** 20):
+    """returns the sha256 hex digest of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def iter_linkdump(path, chunk_lines=10000):
+    """parses a linkdump file chunk_lines lines at a time, generating a MobilityTrace per chunk"""
+    with open(path) as mobility_data:
+        while True:
+            pairs, counts, time_start, time_end = array('q'), array('q'), array('q'), array('q')
+            lines = 0
+            for line in itertools.islice(mobility_data, chunk_lines):
+                lines += 1
+                line = line.split()
+                if not line:
+                    continue
+                pairs.append(int(line[0]))
+                pairs.append(int(line[1]))
+                counts.append(len(line) - 2)
+                for interval in line[2:]:
+                    t1, t2 = interval.split("*")
+                    time_start.append(int(float(t1)))
+                    time_end.append(int(float(t2)))
+            if lines == 0:
+                return
+            if not counts:
+                continue
+            yield MobilityTrace(np.frombuffer(pairs, dtype=np.int64).reshape(-1, 2),
+                                np.frombuffer(counts, dtype=np.int64), np.frombuffer(time_start, dtype=np.int64),
+                                np.frombuffer(time_end, dtype=np.int64))
+
+
+def parse_linkdump(path):
+    """parses a whole linkdump file into a MobilityTrace in memory"""
+    chunks = list(iter_linkdump(path))
+    if not chunks:
+        return MobilityTrace(np.empty((0, 2), dtype=np.int64), *(3 * [np.empty(0, dtype=np.int64)]))
+    return MobilityTrace(*[np.concatenate(columns) for columns in zip(*chunks)])
+
+
+def _write_trace(path, directory, chunk_lines):
+    """parses a linkdump file into .npy files in directory, holding only one chunk of lines in memory at a time"""
+    # the values are appended to raw files first, since the length of the arrays is only known at the end:
+    raw = {field: open(os.path.join(directory, field + ".raw"), 'wb') for field in MobilityTrace._fields}
+    try:
+        for chunk in iter_linkdump(path, chunk_lines):
+            for field, values in zip(MobilityTrace._fields, chunk):
+                raw[field].write(values)
+    finally:
+        for f in raw.values():
+            f.close()
+    for field in MobilityTrace._fields:
+        filename = os.path.join(directory, field + ".raw")
+        length = os.path.getsize(filename) // 8
+        shape = (length // 2, 2) if field == 'pairs' else (length,)
+        values = np.lib.format.open_memmap(os.path.join(directory, field + ".npy"), mode='w+', dtype=np.int64,
+                                           shape=shape)
+        flat = values.reshape(-1)
+        with open(filename, 'rb') as f:
+            for start in range(0, length, _COPY_BLOCK):
+                block = np.fromfile(f, dtype=np.int64, count=_COPY_BLOCK)
+                flat[start:start + len(block)] = block
+        values.flush()
+        del flat, values
+        os.remove(filename)
+
+
+def load_mobility_trace(path, cache_directory='data/cache', chunk_lines=10000):
+    """returns the MobilityTrace of a linkdump file, from the cache if it holds the file's current content
+
+    A missing cache entry is written while parsing the file chunk_lines lines at a time, so that parsing does not
+    hold the whole trace in memory. Without a cache_directory, the file is always parsed into memory."""
+    if cache_directory is None:
+        return parse_linkdump(path)
+    name = os.path.basename(path)
+    entry = os.path.join(cache_directory, "{}.{}".format(name, file_hash(path)))
+    if not os.path.isdir(entry):
+        os.makedirs(cache_directory, exist_ok=True)
+        # write to a temporary directory first, so that an entry is never seen incomplete:
+        temporary = tempfile.mkdtemp(dir=cache_directory)
+        try:
+            _write_trace(path, temporary, chunk_lines)
+        except BaseException:
+            shutil.rmtree(temporary)
+            raise
+        try:
+            os.rename(temporary, entry)
+        except OSError:
+            # another process cached the same content first
+            shutil.rmtree(temporary)
+        for other in os.listdir(cache_directory):
+            digest = other[len(name) + 1:]
+            if other.startswith(name + ".") and len(digest) == 64 and digest.isalnum() and \
+                    other != os.path.basename(entry):
+                shutil.rmtree(os.path.join(cache_directory, other), ignore_errors=True)
+    return MobilityTrace(*[np.load(os.path.join(entry, field + ".npy"), mmap_mode='r')
+                           for field in MobilityTrace._fields])
@@ -1,7 +1,6 @@
-from sqlalchemy import Column, Integer, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, ForeignKey, Boolean, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
 
 Base = declarative_base()
 
@@ -13,6 +12,11 @@ class Experiment(Base):
     group_limit = Column(Integer, nullable=False)
     group_size_limit = Column(Integer, nullable=False)
     broadcast_frequency = Column(Integer, nullable=False)
+    completed = Column(Boolean, nullable=False, default=False)
+    # deliveries of all broadcasts before checkpoint_time are stored; checkpoint_state holds the simulation state at
+    # that time as JSON:
+    checkpoint_time = Column(Integer)
+    checkpoint_state = Column(Text)
     deliveries = relationship('Delivery', backref='experiment')
     deliveries_qry = relationship('Delivery', lazy="dynamic")
 
@@ -30,7 +34,7 @@ class Experiment(Base):
 
     @property
     def undecrypted_deliveries(self):
-        return self.deliveries_qry.filter(not Delivery.decrypted).all()
+        return self.deliveries_qry.filter(Delivery.decrypted == False).all()
 
     def __repr__(self):
         return "<Experiment id={} group_limit={} group_size_limit={} broadcast_frequency={}>".format(self.id,
@@ -99,6 +103,9 @@ class Delivery(Base):
     broadcast_id = Column(Integer, ForeignKey('broadcast.id'), nullable=False)
     recipient_id = Column(Integer, ForeignKey('node.id'))
     decrypted = Column(Boolean)
+    # only set in store-and-forward mode: number of hops and seconds between broadcast and delivery:
+    hops = Column(Integer)
+    delay = Column(Integer)
 
     def __repr__(self):
         return "<Delivery id={} experiment={} broadcast={} recipient={} decrypted={}>".format(self.id, self.experiment,
@@ -116,6 +123,8 @@ class Membership(Base):
     group_id = Column(Integer, ForeignKey('group.id'), primary_key=True)
     node = relationship('Node', backref='membership')
 
-# engine = create_engine('sqlite:///sqlalchemy_example.db')
-engine = create_engine('postgresql://ana@/mobility')
-Base.metadata.create_all(engine)
+
+if __name__ == '__main__':
+    # the database is configured in config.yaml:
+    from bootstrap import get_engine
+    Base.metadata.create_all(get_engine())
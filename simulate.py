@@ -1,126 +1,627 @@
-import logging
-import matplotlib.pyplot as plt
-import statistics
-import pylab
-import psycopg2
+import glob
+import json
+import os
+import pickle
+import queue
 import random
-from multiprocessing import Pool
-
-from sqlalchemy import Column, ForeignKey, Integer, String
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import or_
+import threading
+import time
+from collections import namedtuple
+from multiprocessing import cpu_count, get_context
+
+from sqlalchemy.orm import Session
+
 from model import *
-import yaml
+from bootstrap import DEFAULT_DATABASE, get_mobility_session, insert_rows, is_memory_database, load_config
+from contacts import ContactIndex
+from contact_timeline import ContactTimeline
+from engine import Simulation, SimulationBatch, load_all_groups, load_broadcasts, load_groups
+from forwarding import ForwardingSimulation
+from instrumentation import Instrumentation
+import analyze_results
+import delivery_store
 
+ExperimentParams = namedtuple('ExperimentParams', ['id', 'group_limit', 'group_size_limit', 'broadcast_frequency'])
 
-def run(args):
-    database, time_limit, experiment_id = args
-    # start a database session:
-    engine = create_engine(database, echo=False).execution_options(autocommit=False)
-    Base.metadata.bind = engine
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
-    # fetch the parameters:
-    experiment = session.query(Experiment).filter(Experiment.id == experiment_id).one()
-    group_limit = experiment.group_limit
-    group_size_limit = experiment.group_size_limit
-    broadcast_frequency = experiment.broadcast_frequency
-    print("starting experiment {}: {}-{}-{}".format(experiment_id, group_limit, group_size_limit, broadcast_frequency))
-    # keep a dict of group membership count:
-    groups = dict()
-    matching_groups = session.query(Group). \
-        filter(Group.group_limit == group_limit). \
-        filter(Group.group_size_limit == group_size_limit).all()
-    for group in matching_groups:
-        for member in group.nodes:
-            node = member.node
-            groups.setdefault(node.id, [])
-            groups[node.id].append(group.id)
-    # keep track of next group key to use:
-    next_key_index = dict()
-    for node in groups:
-        next_key_index[node] = random.randint(0, len(groups[node]) - 1)
-    # run simulation:
-    t = 0
-    while t < time_limit:
-        broadcasts = session.query(Broadcast).filter(Broadcast.frequency == broadcast_frequency,
-                                                     Broadcast.time == t).all()
-        for broadcast in broadcasts:
-            sender_id = broadcast.sender_id
-            # find recipients in range:
-            results = session.query(Contact). \
-                filter(or_(Contact.node_1 == sender_id, Contact.node_2 == sender_id)). \
-                filter(Contact.time_start < t, Contact.time_end > t).all()
-            recipients = []
-            for contact in results:
-                if contact.node_1 == sender_id:
-                    recipients.append(contact.node_2)
+
+class RunOptions(object):
+    """Options of a simulation run, as set in config.yaml."""
+
+    def __init__(self, output='database', output_directory='data/deliveries', checkpoint_interval=None, seed=None,
+                 statistics='offline', persist_deliveries=True, instrumentation=False, profile=False,
+                 metrics_directory='data/metrics', progress_interval=60, contacts='index',
+                 contact_timeline='data/timeline', timeline_slice=3600, mode='single_hop', ttl=None,
+                 buffer_size=None, forward_undecryptable=False, batch=False, async_writes=False,
+                 write_batch_size=10000, flush_interval=1.0, write_queue_size=8):
+        self.output = output
+        self.output_directory = output_directory
+        self.checkpoint_interval = checkpoint_interval
+        self.seed = seed
+        self.statistics = statistics
+        self.persist_deliveries = persist_deliveries
+        self.instrumentation = instrumentation
+        self.profile = profile
+        self.metrics_directory = metrics_directory
+        self.progress_interval = progress_interval
+        self.contacts = contacts
+        self.contact_timeline = contact_timeline
+        self.timeline_slice = timeline_slice
+        self.mode = mode
+        self.ttl = ttl
+        self.buffer_size = buffer_size
+        self.forward_undecryptable = forward_undecryptable
+        self.batch = batch
+        self.async_writes = async_writes
+        self.write_batch_size = write_batch_size
+        self.flush_interval = flush_interval
+        self.write_queue_size = write_queue_size
+
+    @classmethod
+    def from_config(cls, data_dict):
+        return cls(**{key: data_dict[key] for key in ('output', 'output_directory', 'checkpoint_interval', 'seed',
+                                                      'statistics', 'persist_deliveries', 'instrumentation', 'profile',
+                                                      'metrics_directory', 'progress_interval', 'contacts',
+                                                      'contact_timeline', 'timeline_slice', 'mode', 'ttl',
+                                                      'buffer_size', 'forward_undecryptable', 'batch',
+                                                      'async_writes', 'write_batch_size', 'flush_interval',
+                                                      'write_queue_size')
+                       if key in data_dict})
+
+    @property
+    def forwarding(self):
+        return self.mode == 'store_and_forward'
+
+    def make_simulation(self, broadcasts, contacts, groups, rng):
+        """returns the Simulation of the configured mode"""
+        if self.forwarding:
+            return ForwardingSimulation(broadcasts, contacts, groups, rng, self.ttl, self.buffer_size,
+                                        self.forward_undecryptable)
+        return Simulation(broadcasts, contacts, groups, rng)
+
+    def instrument(self, experiment_id, time_limit):
+        """returns the Instrumentation of an experiment, or None if instrumentation is disabled"""
+        if not (self.instrumentation or self.profile):
+            return None
+        return Instrumentation(experiment_id, time_limit, self.metrics_directory, self.progress_interval, self.profile)
+
+    def load_contacts(self, session):
+        """returns the ContactIndex of the contact table, or its ContactTimeline if configured or needed for
+        store-and-forward, building and storing the timeline if it does not exist yet"""
+        if self.contacts != 'timeline' and not self.forwarding:
+            return ContactIndex.from_session(session)
+        if not ContactTimeline.exists(self.contact_timeline):
+            ContactTimeline.from_session(session, self.timeline_slice).save(self.contact_timeline)
+        return ContactTimeline.open(self.contact_timeline)
+
+    def rng(self, experiment_id):
+        """returns the random generator of an experiment, seeded from the configured seed if there is one"""
+        if self.seed is None:
+            return random.Random()
+        return random.Random("{}-{}".format(self.seed, experiment_id))
+
+
+class DatabaseDeliveryWriter(object):
+    """Inserts delivery records into the delivery table (with COPY on postgres), committing every batch_size rows.
+
+    Checkpoints are stored in the experiment row. Deliveries committed after the last checkpoint are removed when
+    resuming."""
+
+    COLUMNS = ('experiment_id', 'broadcast_id', 'recipient_id', 'decrypted', 'hops', 'delay')
+
+    def __init__(self, session, experiment_id, batch_size=10000):
+        self.session = session
+        self.experiment_id = experiment_id
+        self.batch_size = batch_size
+        self.batch = []
+
+    def write(self, delivery):
+        self.batch.append((self.experiment_id, delivery.broadcast_id, delivery.recipient_id, delivery.decrypted,
+                           delivery.hops, delivery.delay))
+        if len(self.batch) == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        insert_rows(self.session, Delivery.__table__, self.COLUMNS, self.batch)
+        self.batch = []
+        self.session.commit()
+
+    def _store_checkpoint(self, session, t, state, committed):
+        session.query(Experiment).filter(Experiment.id == self.experiment_id). \
+            update(dict(checkpoint_time=t, checkpoint_state=json.dumps(state)), synchronize_session=False)
+        session.commit()
+        if committed is not None:
+            committed(t)
+
+    def checkpoint(self, t, state, committed=None):
+        """stores the pending deliveries together with the simulation state at time t, then calls committed with t if
+        given"""
+        insert_rows(self.session, Delivery.__table__, self.COLUMNS, self.batch)
+        self.batch = []
+        self._store_checkpoint(self.session, t, state, committed)
+
+    def resume(self):
+        """returns the time and simulation state of the last checkpoint, or None, after removing the deliveries stored
+        after it"""
+        checkpoint_time, checkpoint_state = self.session.query(Experiment.checkpoint_time,
+                                                               Experiment.checkpoint_state). \
+            filter(Experiment.id == self.experiment_id).one()
+        stale = self.session.query(Delivery).filter(Delivery.experiment_id == self.experiment_id)
+        if checkpoint_time is not None:
+            stale = stale.filter(Delivery.broadcast_id.in_(
+                self.session.query(Broadcast.id).filter(Broadcast.time >= checkpoint_time)))
+        stale.delete(synchronize_session=False)
+        self.session.commit()
+        if checkpoint_time is None:
+            return None
+        return checkpoint_time, json.loads(checkpoint_state)
+
+    def close(self):
+        self.flush()
+
+    def completed(self):
+        """called once the experiment is marked as completed"""
+        pass
+
+
+class AsyncDeliveryWriter(DatabaseDeliveryWriter):
+    """Like DatabaseDeliveryWriter, but hands the deliveries over to a background thread that inserts them through a
+    session of its own, so that the simulation does not wait for the database.
+
+    A batch is handed over once it holds batch_size deliveries, or flush_interval seconds after the previous one. At
+    most queue_size batches wait to be inserted; when the database falls behind, write blocks until there is room
+    again. Checkpoints go through the same queue, so they are stored right after the deliveries before them, and
+    their committed callback is called from the background thread."""
+
+    def __init__(self, session, experiment_id, batch_size=10000, flush_interval=1.0, queue_size=8):
+        super().__init__(session, experiment_id, batch_size)
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+        self.error = None
+        self.handed_over = time.monotonic()
+
+    def _insert_batches(self):
+        session = Session(bind=self.session.get_bind())
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                rows, checkpoint = item
+                insert_rows(session, Delivery.__table__, self.COLUMNS, rows)
+                if checkpoint is None:
+                    session.commit()
                 else:
-                    recipients.append(contact.node_1)
-            if len(recipients) == 0 or sender_id not in groups:
-                new_delivery = Delivery(experiment=experiment, broadcast=broadcast)
-            else:
-                # fetch key to encrypt this round:
-                key_index = next_key_index[sender_id]
-                group_key = groups[node][key_index]
-                #update key index:
-                membership_count = len(groups[node])
-                next_key_index[sender_id] = (key_index + 1) % membership_count
-                # check if recipients are in the same group:
-                for recipient in recipients:
-                    if recipient in groups and group_key in groups[recipient]:
-                        decrypted = True
-                    else:
-                        decrypted = False
-                    new_delivery = Delivery(experiment=experiment, broadcast=broadcast, recipient_id=recipient,
-                                            decrypted=decrypted)
-            session.add(new_delivery)
-            session.commit()
-        t += 1
-    print("finished {}".format(experiment_id))
-    print(experiment_id, group_limit, group_size_limit, broadcast_frequency)
+                    self._store_checkpoint(session, *checkpoint)
+        except Exception as e:
+            self.error = e
+            session.rollback()
+        finally:
+            session.close()
 
+    def _hand_over(self, checkpoint=None):
+        """queues the pending deliveries, and the checkpoint if given, waiting while the queue is full"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._insert_batches, daemon=True)
+            self.thread.start()
+        item = (self.batch, checkpoint)
+        self.batch = []
+        self.handed_over = time.monotonic()
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, delivery):
+        self.batch.append((self.experiment_id, delivery.broadcast_id, delivery.recipient_id, delivery.decrypted,
+                           delivery.hops, delivery.delay))
+        if len(self.batch) >= self.batch_size or time.monotonic() - self.handed_over >= self.flush_interval:
+            self._hand_over()
+
+    def flush(self):
+        if self.batch:
+            self._hand_over()
+
+    def checkpoint(self, t, state, committed=None):
+        """queues the pending deliveries together with the simulation state at time t; committed is called with t
+        once they are stored"""
+        self._hand_over((t, state, committed))
+
+    def close(self):
+        """inserts all remaining deliveries and waits for the background thread to finish"""
+        self.flush()
+        if self.thread is not None:
+            while self.thread.is_alive():
+                try:
+                    self.queue.put(None, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise self.error
+
+
+class StatisticsWriter(object):
+    """Feeds deliveries into an analyze_results.StatisticsAccumulator and writes the statistics of the experiment to
+    data/statistics_<id>.json when closed, so that the deliveries need not be read back for analysis.
+
+    Checkpoints pickle the accumulator to data/statistics_<id>.<time>.checkpoint. Only the last one is kept, unless
+    wait_for_commit is set: next to a delivery writer, whose checkpoints may be stored later (e.g. by an
+    AsyncDeliveryWriter), every checkpoint is kept until committed() reports that the delivery writer has stored a
+    later one, so that the one matching it is still there after a crash."""
+
+    def __init__(self, experiment, directory='data', hours=48, wait_for_commit=False):
+        self.experiment = experiment
+        self.directory = directory
+        self.hours = hours
+        self.wait_for_commit = wait_for_commit
+        self.accumulator = analyze_results.StatisticsAccumulator(hours)
+
+    def write(self, delivery):
+        self.accumulator.add(delivery.sender_id, delivery.broadcast_id, delivery.time,
+                             delivery.recipient_id is not None, bool(delivery.decrypted))
+
+    def _checkpoints(self):
+        """returns the times and file names of the stored checkpoints, latest first"""
+        pattern = os.path.join(self.directory, "statistics_{}.*.checkpoint".format(self.experiment.id))
+        return sorted(((int(filename.rsplit(".", 2)[1]), filename) for filename in glob.glob(pattern)),
+                      reverse=True)
+
+    def checkpoint(self, t, state, committed=None):
+        filename = os.path.join(self.directory, "statistics_{}.{}.checkpoint".format(self.experiment.id, t))
+        with open(filename + ".tmp", 'wb') as f:
+            pickle.dump((t, state, self.accumulator), f)
+        os.replace(filename + ".tmp", filename)
+        if not self.wait_for_commit:
+            self.committed(t)
+        if committed is not None:
+            committed(t)
+
+    def committed(self, t):
+        """removes the checkpoints before t, once the checkpoint at t is stored by all writers"""
+        for checkpoint_time, old in self._checkpoints():
+            if checkpoint_time < t:
+                try:
+                    os.remove(old)
+                except FileNotFoundError:
+                    pass
+
+    def resume(self):
+        """restores the accumulator from the last checkpoint and returns its time and simulation state, or None"""
+        checkpoints = self._checkpoints()
+        return self.restore(checkpoints[0][0] if checkpoints else None)
+
+    def restore(self, t):
+        """restores the accumulator from the checkpoint at time t, or resets it if t is None"""
+        for checkpoint_time, filename in self._checkpoints():
+            if checkpoint_time == t:
+                with open(filename, 'rb') as f:
+                    t, state, self.accumulator = pickle.load(f)
+                return t, state
+        if t is not None:
+            raise ValueError("no statistics checkpoint of experiment {} at {}".format(self.experiment.id, t))
+        self.accumulator = analyze_results.StatisticsAccumulator(self.hours)
+        return None
+
+    def close(self):
+        analyze_results.write_results(self.experiment.id,
+                                      analyze_results.results_dict(self.experiment._asdict(),
+                                                                   self.accumulator.statistics()))
+
+    def completed(self):
+        """removes the checkpoints once the experiment is marked as completed, since a crash before that resumes
+        from them"""
+        for _, filename in self._checkpoints():
+            os.remove(filename)
 
-if __name__ == '__main__':
-    database = 'postgresql://ana@/mobility'
 
-    engine = create_engine(database, echo=False).execution_options(autocommit=False)
-    Base.metadata.bind = engine
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
+class MultiWriter(object):
+    """Passes deliveries to several writers; the first one decides where to resume."""
 
-    with open("config.yaml", "r") as config_file:
-        yaml_data = config_file.read()
+    def __init__(self, writers):
+        self.writers = writers
 
-    data_dict = yaml.load(yaml_data)
+    def write(self, delivery):
+        for writer in self.writers:
+            writer.write(delivery)
+
+    def checkpoint(self, t, state, committed=None):
+        # later writers keep their checkpoints until the first one has stored its own, so it is written last:
+        for writer in reversed(self.writers[1:]):
+            writer.checkpoint(t, state)
+        self.writers[0].checkpoint(t, state, lambda t: self._committed(t, committed))
+
+    def _committed(self, t, committed):
+        for writer in self.writers[1:]:
+            writer.committed(t)
+        if committed is not None:
+            committed(t)
+
+    def resume(self):
+        resumed = self.writers[0].resume()
+        for writer in self.writers[1:]:
+            writer.restore(None if resumed is None else resumed[0])
+        return resumed
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+    def completed(self):
+        for writer in self.writers:
+            writer.completed()
+
+
+def make_writer(session, experiment, simulation, time_limit, options):
+    """returns the writer for the deliveries of an experiment simulated until time_limit
+
+    Deliveries are stored in the delivery table (output 'database') or in the columnar store in the output directory
+    (output 'columnar'), unless persist_deliveries is off; with async_writes, database inserts happen in a background
+    thread. With statistics 'online', the statistics of the experiment
+    are computed while simulating."""
+    writers = []
+    if options.persist_deliveries:
+        if options.output == 'columnar':
+            delivery_store.write_broadcasts(options.output_directory, experiment.broadcast_frequency,
+                                            simulation.broadcasts)
+            writers.append(delivery_store.ColumnarDeliveryWriter(options.output_directory, experiment,
+                                                                 options.forwarding))
+        elif options.async_writes:
+            writers.append(AsyncDeliveryWriter(session, experiment.id, options.write_batch_size, options.flush_interval,
+                                               options.write_queue_size))
+        else:
+            writers.append(DatabaseDeliveryWriter(session, experiment.id, options.write_batch_size))
+    if options.statistics == 'online':
+        writers.append(StatisticsWriter(ExperimentParams(experiment.id, experiment.group_limit,
+                                                         experiment.group_size_limit,
+                                                         experiment.broadcast_frequency),
+                                       hours=analyze_results.hours_for(time_limit), wait_for_commit=bool(writers)))
+    if not writers:
+        raise ValueError("deliveries are neither persisted nor analyzed; set persist_deliveries or statistics: online")
+    return writers[0] if len(writers) == 1 else MultiWriter(writers)
+
+
+def run_simulation(session, experiment, simulation, writer, time_limit, options, instrumentation=None):
+    """runs a simulation until time_limit, resuming from the writer's last checkpoint if there is one, passes its
+    deliveries to writer and marks the experiment as completed"""
+    if instrumentation is not None:
+        instrumentation.watch(session.get_bind())
+        simulation = instrumentation.instrument(simulation)
+        writer = instrumentation.wrap_writer(writer)
+    resumed = writer.resume()
+    if resumed is None:
+        print("starting experiment {}: {}-{}-{}".format(experiment.id, experiment.group_limit,
+                                                         experiment.group_size_limit, experiment.broadcast_frequency))
+    else:
+        checkpoint_time, state = resumed
+        simulation.seek(checkpoint_time)
+        simulation.restore(state)
+        print("resuming experiment {} at {}: {}-{}-{}".format(experiment.id, checkpoint_time, experiment.group_limit,
+                                                               experiment.group_size_limit,
+                                                               experiment.broadcast_frequency))
+
+    def checkpoint(t):
+        writer.checkpoint(t, simulation.state())
+
+    if instrumentation is not None:
+        instrumentation.start(0 if resumed is None else resumed[0])
+    for delivery in simulation.run(time_limit, checkpoint, options.checkpoint_interval):
+        writer.write(delivery)
+    writer.close()
+    session.query(Experiment).filter(Experiment.id == experiment.id). \
+        update(dict(completed=True), synchronize_session=False)
+    session.commit()
+    writer.completed()
+    if instrumentation is not None:
+        instrumentation.finish()
+    print("finished {}".format(experiment.id))
+    print(experiment.id, experiment.group_limit, experiment.group_size_limit, experiment.broadcast_frequency)
+
+
+def run_batch(session, experiments, simulations, time_limit, options, instrumentation=None):
+    """runs the simulations of experiments with the same broadcast frequency as SimulationBatches, passing the
+    deliveries of every experiment to its own writer, and marks the experiments as completed
+
+    Experiments resumed from different checkpoints are batched separately."""
+    writers = [make_writer(session, experiment, simulation, time_limit, options)
+               for experiment, simulation in zip(experiments, simulations)]
+    batches = dict()
+    for i, writer in enumerate(writers):
+        resumed = writer.resume()
+        if resumed is not None:
+            simulations[i].restore(resumed[1])
+        batches.setdefault(None if resumed is None else resumed[0], []).append(i)
+    for checkpoint_time, indices in sorted(batches.items(), key=lambda item: item[0] or 0):
+        print("{} experiments {} at {}: {}".format("resuming" if checkpoint_time else "starting",
+                                                   [experiments[i].id for i in indices], checkpoint_time or 0,
+                                                   ", ".join("{}-{}-{}".format(experiments[i].group_limit,
+                                                                               experiments[i].group_size_limit,
+                                                                               experiments[i].broadcast_frequency)
+                                                             for i in indices)))
+        batch = SimulationBatch([simulations[i] for i in indices])
+        batch_writers = [writers[i] for i in indices]
+        if instrumentation is not None:
+            instrumentation.watch(session.get_bind())
+            batch = instrumentation.instrument(batch)
+            batch_writers = [instrumentation.wrap_writer(writer) for writer in batch_writers]
+            instrumentation.start(checkpoint_time or 0)
+        if checkpoint_time is not None:
+            batch.seek(checkpoint_time)
+
+        def checkpoint(t):
+            for i, writer in enumerate(batch_writers):
+                writer.checkpoint(t, batch.state(i))
+
+        for i, delivery in batch.run(time_limit, checkpoint, options.checkpoint_interval):
+            batch_writers[i].write(delivery)
+        for writer in batch_writers:
+            writer.close()
+        session.query(Experiment).filter(Experiment.id.in_([experiments[i].id for i in indices])). \
+            update(dict(completed=True), synchronize_session=False)
+        session.commit()
+        for writer in batch_writers:
+            writer.completed()
+        if instrumentation is not None:
+            instrumentation.finish()
+        print("finished {}".format([experiments[i].id for i in indices]))
+
+
+def run_experiment(session, experiment_id, time_limit, options=RunOptions()):
+    """loads the inputs of one experiment from the database, simulates it and stores its deliveries"""
+    experiment = session.query(Experiment).filter(Experiment.id == experiment_id).one()
+    instrumentation = options.instrument(experiment_id, time_limit)
+    load_start = time.perf_counter()
+    simulation = options.make_simulation(load_broadcasts(session, experiment.broadcast_frequency, time_limit),
+                                         options.load_contacts(session),
+                                         load_groups(session, experiment.group_limit, experiment.group_size_limit),
+                                         options.rng(experiment_id))
+    if instrumentation is not None:
+        instrumentation.timers["load"] += time.perf_counter() - load_start
+    run_simulation(session, experiment, simulation, make_writer(session, experiment, simulation, time_limit, options),
+                   time_limit, options, instrumentation)
+
+
+# inputs shared by all experiments of a sweep; loaded once by run_sweep and inherited by the forked workers:
+_shared = dict()
+_worker_session = None
+
+
+def load_shared_inputs(session, broadcast_freqs, time_limit, options=RunOptions()):
+    """loads the contacts, the broadcasts of every frequency and the groups of every configuration"""
+    return dict(
+        contacts=options.load_contacts(session),
+        broadcasts={broadcast_frequency: load_broadcasts(session, broadcast_frequency, time_limit)
+                    for broadcast_frequency in broadcast_freqs},
+        groups=load_all_groups(session)
+    )
+
+
+def worker_count(workers='auto'):
+    """returns the number of worker processes to use; 'auto' uses every core available to this process"""
+    if workers in (None, 'auto', 0):
+        return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else cpu_count()
+    return int(workers)
+
+
+def _init_worker(database):
+    # database connections must not be shared with the parent process:
+    global _worker_session
+    _worker_session = get_mobility_session(database=database)
+
+
+def _run_shared(args):
+    experiment, time_limit, options = args
+    groups = _shared["groups"].get((experiment.group_limit, experiment.group_size_limit), dict())
+    simulation = options.make_simulation(_shared["broadcasts"][experiment.broadcast_frequency], _shared["contacts"],
+                                         groups, options.rng(experiment.id))
+    writer = make_writer(_worker_session, experiment, simulation, time_limit, options)
+    run_simulation(_worker_session, experiment, simulation, writer, time_limit, options,
+                   options.instrument(experiment.id, time_limit))
+    return experiment.id
+
+
+def _run_shared_batch(args):
+    experiments, time_limit, options = args
+    broadcasts = _shared["broadcasts"][experiments[0].broadcast_frequency]
+    simulations = [options.make_simulation(broadcasts, _shared["contacts"],
+                                           _shared["groups"].get((experiment.group_limit, experiment.group_size_limit),
+                                                                 dict()),
+                                           options.rng(experiment.id))
+                   for experiment in experiments]
+    run_batch(_worker_session, experiments, simulations, time_limit, options,
+              options.instrument("batch_{}".format(experiments[0].broadcast_frequency), time_limit))
+    return [experiment.id for experiment in experiments]
+
+
+def run_sweep(session, database, experiments, time_limit, options=RunOptions(), workers='auto', progress=True):
+    """simulates all given experiments in parallel
+
+    The contacts, broadcasts and groups are loaded once and inherited by the forked worker processes. Experiments are
+    started longest first, i.e. in order of decreasing number of broadcasts, to keep the last workers from finishing
+    long after the others. With a single worker or the in-memory database, the experiments run in this process.
+
+    With the batch option, all experiments with the same broadcast frequency are simulated in a single pass by one
+    worker (see run_batch). Store-and-forward experiments are always simulated one by one, since there the spreading of
+    a broadcast depends on who can decrypt it."""
+    global _shared, _worker_session
+    _shared = load_shared_inputs(session, {experiment.broadcast_frequency for experiment in experiments}, time_limit,
+                                 options)
+    experiments = sorted(experiments, key=lambda e: len(_shared["broadcasts"][e.broadcast_frequency].id),
+                         reverse=True)
+    if options.batch and not options.forwarding:
+        by_frequency = dict()
+        for experiment in experiments:
+            by_frequency.setdefault(experiment.broadcast_frequency, []).append(experiment)
+        run_task = _run_shared_batch
+        tasks = [(batch, time_limit, options) for batch in by_frequency.values()]
+    else:
+        run_task = _run_shared
+        tasks = [(experiment, time_limit, options) for experiment in experiments]
+    start_time = time.time()
+    if worker_count(workers) == 1 or is_memory_database(database):
+        pool = None
+        _worker_session = session
+        finished = map(run_task, tasks)
+    else:
+        pool = get_context('fork').Pool(worker_count(workers), initializer=_init_worker, initargs=(database,))
+        finished = pool.imap_unordered(run_task, tasks)
+    for done, experiment_id in enumerate(finished, 1):
+        if progress:
+            print("sweep: {}/{} {} done after {:.0f}s (last: {})".format(done, len(tasks),
+                                                                       "batches" if run_task is _run_shared_batch
+                                                                       else "experiments", time.time() - start_time,
+                                                                       experiment_id))
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def get_experiment(session, group_limit, group_size_limit, broadcast_frequency, resume=True):
+    """returns the experiment with the given parameters, creating it unless resume is set and it already exists"""
+    experiment = None
+    if resume:
+        experiment = session.query(Experiment).filter(Experiment.group_limit == group_limit,
+                                                      Experiment.group_size_limit == group_size_limit,
+                                                      Experiment.broadcast_frequency == broadcast_frequency). \
+            order_by(Experiment.id).first()
+    if experiment is None:
+        experiment = Experiment(broadcast_frequency=broadcast_frequency, group_limit=group_limit,
+                                group_size_limit=group_size_limit, completed=False)
+        session.add(experiment)
+        session.commit()
+    return experiment
+
+
+if __name__ == '__main__':
+    data_dict = load_config()
+    database = data_dict.get("database", DEFAULT_DATABASE)
+    session = get_mobility_session(database=database)
     group_limits = data_dict["group_limits"]
     group_sizes = data_dict["group_sizes"]
     broadcast_freqs = data_dict["broadcast_freqs"]
     node_count = data_dict["node_count"]
     total_time = data_dict["total_time"]
+    options = RunOptions.from_config(data_dict)
+    workers = data_dict.get("workers", "auto")
+    progress = data_dict.get("progress", True)
+    resume = data_dict.get("resume", True)
 
     config = []
     for broadcast_frequency in broadcast_freqs:
-        # add baseline config:
-        new_experiment = Experiment(broadcast_frequency=broadcast_frequency, group_limit=1, group_size_limit=node_count)
-        session.add(new_experiment)
-        session.commit()
-        config.append([database, total_time, new_experiment.id])
-        # add remaining configs:
-        for group_limit in group_limits:
-            for group_size_limit in group_sizes:
-                new_experiment = Experiment(broadcast_frequency=broadcast_frequency,
-                                            group_limit=group_limit,
-                                            group_size_limit=group_size_limit)
-                session.add(new_experiment)
-                session.commit()
-                config.append([database, total_time, new_experiment.id])
-
-            # import pdb
-            # pdb.set_trace()
-
-    p = Pool(7, maxtasksperchild=1)
-    p.map(run, config)
+        # add baseline config, then remaining configs:
+        params = [(1, node_count)] + [(group_limit, group_size_limit) for group_limit in group_limits
+                                      for group_size_limit in group_sizes]
+        for group_limit, group_size_limit in params:
+            experiment = get_experiment(session, group_limit, group_size_limit, broadcast_frequency, resume)
+            if experiment.completed:
+                print("skipping completed experiment {}".format(experiment.id))
+                continue
+            config.append(ExperimentParams(experiment.id, group_limit, group_size_limit, broadcast_frequency))
+
+    run_sweep(session, database, config, total_time, options, workers, progress)
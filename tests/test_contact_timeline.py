@@ -0,0 +1,27 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from contact_timeline import ContactTimeline
+from contacts import ContactIndex
+
+
+def test_recipients_of_opened_timeline_with_overlapping_contacts(tmp_path):
+    """overlapping contacts of the same pair give duplicate snapshot entries, which must not touch the stored arrays"""
+    rng = random.Random(3)
+    contacts = [(1, 2, 3500, 3700), (1, 2, 3550, 3800), (2, 1, 3590, 7300), (3, 4, 100, 7300)]
+    for _ in range(300):
+        node_1, node_2 = rng.sample(range(6), 2)
+        start = rng.randint(0, 10000)
+        contacts.append((node_1, node_2, start, start + rng.randint(1, 4000)))
+    ContactTimeline.build(*zip(*contacts), slice_length=3600).save(str(tmp_path))
+    timeline = ContactTimeline.open(str(tmp_path))
+    index = ContactIndex(contacts)
+    nodes = list(range(8))
+    # queries jump back and forth in time:
+    for t in [3600, 3650, 7200, 3600, 100, 7300, 3601] + [rng.randint(0, 15000) for _ in range(200)]:
+        indptr, indices = timeline.recipients(nodes, t)
+        for i, node in enumerate(nodes):
+            assert sorted(indices[indptr[i]:indptr[i + 1]].tolist()) == sorted(index.neighbours(node, t))
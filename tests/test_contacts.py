@@ -0,0 +1,50 @@
+import os
+import random
+import sys
+from bisect import bisect_left, bisect_right
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import contacts
+from contacts import ContactIndex
+
+
+def _brute_force(node_contacts, time_start, time_end):
+    """the peers of all (start, end, peer) contacts with start < time_end and end > time_start"""
+    return [peer for start, end, peer in node_contacts if start < time_end and end > time_start]
+
+
+def test_queries_match_brute_force():
+    """hundreds of short and long contacts per node, so that most queries leave more than _SCAN_LIMIT candidates and
+    search the tree; the numbers of contacts per node vary, so that the trees are of all shapes"""
+    rng = random.Random(5)
+    contact_list = []
+    for node in range(2, 40):
+        for _ in range(rng.randint(40, 300)):
+            start = rng.randint(0, 20000)
+            length = rng.randint(1, 20) if rng.random() < 0.8 else rng.randint(1000, 8000)
+            contact_list.append((node, rng.randrange(node), start, start + length))
+    # intervals sharing their start or end times:
+    contact_list += [(0, 1, 5000, 5000 + length) for length in (1, 10, 100, 5000)]
+    contact_list += [(0, 2, 6000 - length, 6000) for length in (1, 10, 100, 5000)]
+    index = ContactIndex(contact_list)
+    by_node = dict()
+    for node_1, node_2, start, end in contact_list:
+        by_node.setdefault(node_1, []).append((start, end, node_2))
+        by_node.setdefault(node_2, []).append((start, end, node_1))
+    times = [rng.randint(-100, 30000) for _ in range(100)] + [5000, 5001, 5999, 6000]
+
+    searched = 0
+    for node in range(41):
+        node_intervals = index._nodes.get(node)
+        for t in times:
+            assert sorted(index.neighbours(node, t)) == sorted(_brute_force(by_node.get(node, []), t, t))
+            if node_intervals is not None:
+                starts = node_intervals.starts
+                searched += bisect_left(starts, t) - bisect_right(starts, t - node_intervals.max_length) > \
+                    contacts._SCAN_LIMIT
+        for time_start in times:
+            time_end = time_start + rng.choice([0, 1, 50, 3000])
+            assert index.neighbours_during(node, time_start, time_end) == \
+                set(_brute_force(by_node.get(node, []), time_start, time_end))
+    assert searched > len(times)
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import delivery_store
+from analyze_results import read_delivery_columns
+from engine import BroadcastSchedule, DeliveryRecord
+from simulate import ExperimentParams
+
+
+def _schedule(ids, sender_ids, times):
+    return BroadcastSchedule(np.array(times), np.array(ids), np.array(sender_ids))
+
+
+def _store_experiment(directory, broadcast_ids):
+    writer = delivery_store.ColumnarDeliveryWriter(directory, ExperimentParams(1, 2, 3, 5))
+    for broadcast_id in broadcast_ids:
+        writer.write(DeliveryRecord(broadcast_id, 0, 0, 4, True))
+    writer.close()
+
+
+def test_regenerated_broadcasts_replace_the_stored_ones(tmp_path):
+    directory = str(tmp_path)
+    delivery_store.write_broadcasts(directory, 5, _schedule([1, 2, 3], [7, 8, 9], [0, 5, 10]))
+    delivery_store.write_broadcasts(directory, 5, _schedule([4, 5], [1, 2], [3, 8]))
+    broadcasts = delivery_store.open_broadcasts(directory, 5)
+    assert broadcasts["id"].tolist() == [4, 5]
+    _store_experiment(directory, [5, 4, 5])
+    columns = read_delivery_columns(directory, 1)[1]
+    assert columns.sender.tolist() == [2, 1, 2]
+    assert columns.time.tolist() == [8, 3, 8]
+
+
+@pytest.mark.parametrize('broadcast_ids', [[1, 2], [4, 9]])
+def test_deliveries_of_other_broadcasts_are_rejected(tmp_path, broadcast_ids):
+    directory = str(tmp_path)
+    delivery_store.write_broadcasts(directory, 5, _schedule([4, 5], [1, 2], [3, 8]))
+    _store_experiment(directory, broadcast_ids)
+    with pytest.raises(ValueError):
+        read_delivery_columns(directory, 1)
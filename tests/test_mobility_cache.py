@@ -0,0 +1,23 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from mobility_cache import load_mobility_trace, parse_linkdump
+
+
+def test_chunked_cache_matches_whole_file_parse(tmp_path):
+    path = str(tmp_path / "trace.linkdump")
+    with open(path, 'w') as f:
+        f.write("1 2 1*5 7*9\n\n\n3 4\n5 1 2.5*3.0\n2 3 4*8 9*12 20*30\n")
+    parsed = parse_linkdump(path)
+    assert parsed.pairs.tolist() == [[1, 2], [3, 4], [5, 1], [2, 3]]
+    assert parsed.counts.tolist() == [2, 0, 1, 3]
+    for chunk_lines in (1, 2, 100):
+        cached = load_mobility_trace(path, str(tmp_path / "cache_{}".format(chunk_lines)), chunk_lines)
+        assert all(np.array_equal(a, b) for a, b in zip(parsed, cached))
+        # the cache entry is opened again on the next load:
+        reloaded = load_mobility_trace(path, str(tmp_path / "cache_{}".format(chunk_lines)), chunk_lines)
+        assert all(np.array_equal(a, b) for a, b in zip(parsed, reloaded))
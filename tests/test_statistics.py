@@ -0,0 +1,41 @@
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from analyze_results import DeliveryColumns, StatisticsAccumulator, compute_statistics, results_dict
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_accumulator_matches_compute_statistics(seed):
+    """broadcasts are delivered several times in random order, heard or not and decrypted or not, and sent up to 60
+    hours into a simulation whose statistics start with 48 hourly buckets"""
+    rng = random.Random(seed)
+    params = dict(group_limit=3, group_size_limit=5, broadcast_frequency=600)
+    senders = [rng.randrange(10) for _ in range(300)]
+    times = [rng.randrange(60 * 3600) for _ in range(300)]
+    deliveries = []
+    for _ in range(2000):
+        broadcast = rng.randrange(300)
+        heard = rng.random() < 0.8
+        deliveries.append((senders[broadcast], broadcast, times[broadcast], heard, heard and rng.random() < 0.3))
+    accumulator = StatisticsAccumulator(48)
+    for delivery in deliveries:
+        accumulator.add(*delivery)
+    columns = DeliveryColumns(*[np.array(column) for column in zip(*deliveries)])
+    expected = compute_statistics(params, columns, 48)
+    assert results_dict(params, accumulator.statistics()) == expected
+    # some broadcasts are decrypted only after they were heard without being decrypted:
+    undecrypted = set()
+    decrypted_later = set()
+    for _, broadcast, _, heard, decrypted in deliveries:
+        if decrypted and broadcast in undecrypted:
+            decrypted_later.add(broadcast)
+        elif heard and not decrypted:
+            undecrypted.add(broadcast)
+    assert decrypted_later
+    assert len(next(iter(expected["statistics"]["hourly_total"].values()))) > 48
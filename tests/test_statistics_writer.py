@@ -0,0 +1,69 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from simulate import ExperimentParams, MultiWriter, StatisticsWriter
+
+
+class _LateWriter(object):
+    """a delivery writer whose checkpoints are only stored when store() is called, like an AsyncDeliveryWriter"""
+
+    def __init__(self):
+        self.pending = []
+
+    def write(self, delivery):
+        pass
+
+    def checkpoint(self, t, state, committed=None):
+        self.pending.append((t, committed))
+
+    def store(self):
+        for t, committed in self.pending:
+            committed(t)
+        self.pending = []
+
+
+def _times(writer):
+    return sorted(t for t, _ in writer._checkpoints())
+
+
+def test_statistics_checkpoints_are_kept_until_the_delivery_checkpoint_is_stored(tmp_path):
+    experiment = ExperimentParams(1, 2, 3, 5)
+    statistics = StatisticsWriter(experiment, str(tmp_path), wait_for_commit=True)
+    deliveries = _LateWriter()
+    writer = MultiWriter([deliveries, statistics])
+    for t in range(100, 1100, 100):
+        writer.checkpoint(t, dict())
+    assert _times(statistics) == list(range(100, 1100, 100))
+    deliveries.pending, late = deliveries.pending[:3], deliveries.pending[3:]
+    deliveries.store()
+    assert _times(statistics) == list(range(300, 1100, 100))
+    assert statistics.restore(300)[0] == 300
+    deliveries.pending = late
+    deliveries.store()
+    assert _times(statistics) == [1000]
+
+
+def test_standalone_statistics_writer_keeps_its_last_checkpoint(tmp_path):
+    statistics = StatisticsWriter(ExperimentParams(1, 2, 3, 5), str(tmp_path))
+    for t in (100, 200, 300):
+        statistics.checkpoint(t, dict())
+    assert _times(statistics) == [300]
+
+
+def test_statistics_checkpoints_survive_close_until_completed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    experiment = ExperimentParams(1, 2, 3, 5)
+    deliveries = _LateWriter()
+    deliveries.close = deliveries.completed = lambda: None
+    statistics = StatisticsWriter(experiment, str(tmp_path), wait_for_commit=True)
+    writer = MultiWriter([deliveries, statistics])
+    writer.checkpoint(100, dict(rng=1))
+    deliveries.store()
+    os.makedirs("data")
+    writer.close()
+    # a crash here resumes from the checkpoint the delivery writer reports:
+    assert StatisticsWriter(experiment, str(tmp_path), wait_for_commit=True).restore(100) == (100, dict(rng=1))
+    writer.completed()
+    assert _times(statistics) == []